@@ -0,0 +1,342 @@
+""" bench.py measures re2 against python's re on generated texts, and
+saves the results as JSON so that two commits can be compared.
+
+usage:
+    python bench.py                      # the full run, ~1MB texts
+    python bench.py --quick              # small texts, for a smoke test
+    python bench.py --size 8 -o new.json # 8MB buffers
+    python bench.py --compare old.json new.json
+
+every case reports the compile time, the throughput of finditer over a
+buffer, the latency percentiles of search over short records and the
+peak memory traced while it runs. the pathological cases run in a child
+process each, which is killed after a timeout, because the backtracking
+of python's re takes exponential time on them.
+"""
+
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import subprocess
+import sys
+import time
+import tracemalloc
+import typing as t
+
+import re2
+
+
+SEED = 2024
+WORDS = ['alpha', 'beta', 'gamma', 'delta', 'error', 'warning', 'info',
+         'user', 'session', 'request', 'timeout', 'cache', 'disk', 'net']
+UNICODE = 'αβγδεζηθ абвгдежз 中文字符串 日本語 한국어 émigré naïve '
+
+# (family, name, pattern, corpus), \w is [A-Za-z_] in re2, so the counts
+# of keyvalue differ from re, and a literal comma needs to be escaped
+PATTERNS = [
+    ('literal', 'word', 'timeout', 'log'),
+    ('literal', 'rare', 'segfault', 'log'),
+    ('class', 'digits', r'\d+', 'csv'),
+    ('class', 'hex', r'[0-9a-f]{8}', 'log'),
+    ('class', 'unicode', r'[α-ω]+', 'unicode'),
+    ('alternation', 'levels', 'error|warning|fatal', 'log'),
+    ('alternation', 'words', '|'.join(WORDS), 'log'),
+    ('repeat', 'ip', r'\d{1,3}\.\d{1,3}\.\d{1,3}\.\d{1,3}', 'log'),
+    ('repeat', 'long', r'x[a-z]{2,200}y', 'log'),
+    ('capture', 'keyvalue', r'(\w+)=(\w+)', 'log'),
+    ('capture', 'csv', r'(\d+)\,([a-z]+)\,(\d+)\.(\d+)', 'csv'),
+    ('capture', 'date', r'(\d+)-(\d+)-(\d+) (\d+):(\d+):(\d+)', 'log'),
+]
+
+# (name, pattern, text) of size n
+PATHOLOGICAL = [
+    ('optional', lambda n: '(a?){%d}a{%d}' % (n, n), lambda n: 'a' * n),
+    ('nested', lambda n: '(x+x+)+y', lambda n: 'x' * n),
+    ('alternation', lambda n: '(a|aa)+b', lambda n: 'a' * n),
+]
+
+
+def logLine(rng:random.Random) -> str:
+    return '2024-%02d-%02d %02d:%02d:%02d %s %d.%d.%d.%d user=%s id=%08x %s' % (
+        rng.randint(1, 12), rng.randint(1, 28), rng.randint(0, 23),
+        rng.randint(0, 59), rng.randint(0, 59), rng.choice(WORDS[4:7]),
+        rng.randint(1, 255), rng.randint(0, 255), rng.randint(0, 255),
+        rng.randint(0, 255), rng.choice(WORDS), rng.getrandbits(32),
+        ' '.join(rng.choice(WORDS) for _ in range(rng.randint(2, 8))))
+
+
+def csvLine(rng:random.Random) -> str:
+    return '%d,%s,%d.%02d,%s' % (
+        rng.randint(0, 10 ** 6), rng.choice(WORDS), rng.randint(0, 9999),
+        rng.randint(0, 99), rng.choice(WORDS))
+
+
+def unicodeLine(rng:random.Random) -> str:
+    return ''.join(rng.choice(UNICODE) for _ in range(rng.randint(20, 80)))
+
+
+LINES = {'log': logLine, 'csv': csvLine, 'unicode': unicodeLine}
+
+
+def corpus(kind:str, size:int, seed:int=SEED) -> list[str]:
+    """ corpus returns the lines of a generated text of about size
+    characters, the same seed gives the same lines.
+    """
+    rng = random.Random('%s-%d' % (kind, seed))
+    lines = []
+    total = 0
+    while total < size:
+        line = LINES[kind](rng)
+        lines.append(line)
+        total += len(line) + 1
+    return lines
+
+
+def percentiles(values:list[float], points=(50, 90, 99)) -> dict:
+    values = sorted(values)
+    if len(values) == 0:
+        return {'p%d' % p: None for p in points}
+    return {'p%d' % p: values[min(len(values) - 1, len(values) * p // 100)]
+            for p in points}
+
+
+class Engine(object):
+    """ Engine is the few calls the benchmark makes, for re2 and re. """
+    def __init__(self, name:str):
+        self.name = name
+
+    def compile(self, pattern:str):
+        if self.name == 're':
+            re.purge()
+            return re.compile(pattern)
+        regexp = re2.RegExp(pattern)
+        regexp.compile()
+        return regexp
+
+    def search(self, compiled, text:str):
+        if self.name == 're':
+            return compiled.search(text)
+        return compiled.exec(text)
+
+    def count(self, compiled, text:str) -> int:
+        return sum(1 for _ in compiled.finditer(text))
+
+
+def measure(engine:Engine, pattern:str, lines:list[str],
+            records:int) -> dict:
+    """ measure runs one pattern on one engine. """
+    tracemalloc.start()
+    try:
+        start = time.perf_counter()
+        compiled = engine.compile(pattern)
+        compileTime = time.perf_counter() - start
+
+        buffer = '\n'.join(lines)
+        start = time.perf_counter()
+        matches = engine.count(compiled, buffer)
+        scanTime = time.perf_counter() - start
+
+        latencies = []
+        for line in lines[:records]:
+            start = time.perf_counter()
+            engine.search(compiled, line)
+            latencies.append(time.perf_counter() - start)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    result = {
+        'compile': compileTime,
+        'scan': scanTime,
+        'matches': matches,
+        'throughput': len(buffer) / scanTime / 2 ** 20 if scanTime else None,
+        'latency': percentiles(latencies),
+        'memory': peak,
+    }
+    if engine.name == 're2':
+        result['plan'] = {k: compiled.explain()[k] for k in ('scan', 'capture')}
+    return result
+
+
+def runCase(engine:str, pattern:str, text:str) -> dict:
+    """ runCase is run in the child process of a pathological case. """
+    start = time.perf_counter()
+    compiled = Engine(engine).compile(pattern)
+    compileTime = time.perf_counter() - start
+    start = time.perf_counter()
+    found = Engine(engine).search(compiled, text) is not None
+    return {'compile': compileTime, 'search': time.perf_counter() - start,
+            'found': found}
+
+
+def pathological(engine:str, pattern:str, text:str,
+                 timeout:float) -> dict:
+    """ pathological runs a case in a child process, which is killed
+    after timeout seconds.
+    """
+    case = json.dumps([engine, pattern, text])
+    try:
+        proc = subprocess.run([sys.executable, os.path.abspath(__file__),
+                               '--case', case], capture_output=True,
+                              text=True, timeout=timeout,
+                              cwd=os.path.dirname(os.path.abspath(__file__)))
+    except subprocess.TimeoutExpired:
+        return {'timeout': timeout}
+    if proc.returncode != 0:
+        return {'error': proc.stderr.strip().splitlines()[-1:]}
+    return json.loads(proc.stdout)
+
+
+def commit() -> t.Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+                              capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))
+                              ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(size:int, records:int, sizes:list[int], timeout:float,
+        families:t.Optional[set]=None, out=sys.stdout) -> dict:
+    """ run measures all the cases and returns the results. """
+    results = {
+        'meta': {
+            'commit': commit(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'size': size,
+            'records': records,
+        },
+        'cases': [],
+        'pathological': [],
+    }
+    corpora = {}
+    engines = [Engine('re2'), Engine('re')]
+    for family, name, pattern, kind in PATTERNS:
+        if families and family not in families:
+            continue
+        if kind not in corpora:
+            corpora[kind] = corpus(kind, size)
+        case = {'family': family, 'name': name, 'pattern': pattern,
+                'corpus': kind}
+        for engine in engines:
+            case[engine.name] = measure(engine, pattern, corpora[kind],
+                                        records)
+        results['cases'].append(case)
+        report(case, out)
+
+    for name, pattern, text in PATHOLOGICAL:
+        if families and 'pathological' not in families:
+            continue
+        for n in sizes:
+            case = {'name': name, 'n': n, 'pattern': pattern(n)}
+            for engine in engines:
+                case[engine.name] = pathological(engine.name, pattern(n),
+                                                 text(n), timeout)
+            results['pathological'].append(case)
+            report(case, out)
+    return results
+
+
+def seconds(value:t.Optional[float]) -> str:
+    if value is None:
+        return '-'
+    if value < 1e-3:
+        return '%.1fus' % (value * 1e6)
+    if value < 1:
+        return '%.1fms' % (value * 1e3)
+    return '%.2fs' % value
+
+
+def report(case:dict, out) -> None:
+    if 'family' in case:
+        line = '%-12s %-9s' % (case['family'], case['name'])
+        for name in ('re2', 're'):
+            r = case[name]
+            line += '  %s: %s scan %s p50 %s p99 %s' % (
+                name, seconds(r['compile']), seconds(r['scan']),
+                seconds(r['latency']['p50']), seconds(r['latency']['p99']))
+    else:
+        line = '%-12s n=%-6d' % (case['name'], case['n'])
+        for name in ('re2', 're'):
+            r = case[name]
+            if 'timeout' in r:
+                line += '  %s: timeout' % name
+            elif 'error' in r:
+                line += '  %s: error' % name
+            else:
+                line += '  %s: %s' % (name, seconds(r['search']))
+    print(line, file=out)
+
+
+def compare(old:dict, new:dict, out=sys.stdout) -> None:
+    """ compare prints how much slower (>1) or faster the scan and the
+    median latency of re2 got from one result to another.
+    """
+    before = {(c['family'], c['name']): c['re2'] for c in old['cases']}
+    print('%s -> %s' % (old['meta'].get('commit'), new['meta'].get('commit')),
+          file=out)
+    for case in new['cases']:
+        key = (case['family'], case['name'])
+        if key not in before:
+            continue
+        a, b = before[key], case['re2']
+        ratios = []
+        for label, x, y in (('scan', a['scan'], b['scan']),
+                            ('p50', a['latency']['p50'], b['latency']['p50'])):
+            ratios.append('%s %.2fx' % (label, y / x) if x and y else
+                          '%s -' % label)
+        print('%-12s %-9s  %s' % (key + ('  '.join(ratios),)), file=out)
+
+
+def main(argv:list[str]=None, out=None) -> int:
+    out = out or sys.stdout
+    parser = argparse.ArgumentParser(prog='bench.py', description=
+        'measure re2 against python\'s re')
+    parser.add_argument('--size', type=float, default=1.0,
+                        help='the size of the texts in MB')
+    parser.add_argument('--records', type=int, default=1000,
+                        help='the records searched for the latency')
+    parser.add_argument('--quick', action='store_true',
+                        help='small texts and cases, for a smoke test')
+    parser.add_argument('--family', action='append',
+                        help='only run this family of patterns')
+    parser.add_argument('--timeout', type=float, default=10.0,
+                        help='the seconds a pathological case may take')
+    parser.add_argument('-o', '--output', help='save the results as JSON')
+    parser.add_argument('--compare', nargs=2, metavar=('OLD', 'NEW'),
+                        help='compare two saved results')
+    parser.add_argument('--case', help=argparse.SUPPRESS)
+    args = parser.parse_args(argv)
+
+    if args.case:
+        print(json.dumps(runCase(*json.loads(args.case))), file=out)
+        return 0
+    if args.compare:
+        with open(args.compare[0]) as f1, open(args.compare[1]) as f2:
+            compare(json.load(f1), json.load(f2), out)
+        return 0
+
+    size = int(args.size * 2 ** 20)
+    records = args.records
+    sizes = [10, 20, 25, 30]
+    if args.quick:
+        size, records, sizes = 16 * 1024, 100, [10, 20]
+        args.timeout = min(args.timeout, 5.0)
+    families = set(args.family) if args.family else None
+    results = run(size, records, sizes, args.timeout, families, out)
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=1)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
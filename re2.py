@@ -49,12 +49,24 @@ For fun only:)
 """
 
 from __future__ import annotations
-from collections import OrderedDict
-from itertools import count
-
+from array import array
+from bisect import bisect_right
+from collections import OrderedDict, namedtuple
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from itertools import chain, count, islice
+
+import argparse
+import hashlib
+import marshal
+import mmap
+import os
 import sys
-import copy
+import tempfile
+import threading
+import time
 import typing as t
+import weakref
 
 def readUtf8(s:str) -> int:
     b = s.encode('utf-8')
@@ -84,9 +96,9 @@ def readUtf8(s:str) -> int:
     # 4-bytes
     if b[0] & 0xf0 == 0xf0:
         assert(len(b) == 4)
-        utf8 = ((b[0] & 0x07) << 24) + \
-               ((b[1] & 0x3f) << 16) + \
-               ((b[2] & 0x3f) << 8) + \
+        utf8 = ((b[0] & 0x07) << 18) + \
+               ((b[1] & 0x3f) << 12) + \
+               ((b[2] & 0x3f) << 6) + \
                 (b[3] & 0x3f)
         return utf8
 
@@ -105,6 +117,21 @@ def readUnicode(s:str) -> int:
         
     return u
 
+def readText(text:t.Union[str, bytes, bytearray, memoryview]) -> memoryview:
+    """ readText returns the code points of the whole text in one go, 
+    so that the matchers index integers instead of decoding every
+    character. bytes-like objects are not copied, their code points
+    are the byte values.
+    """
+    if isinstance(text, str):
+        encoding = 'utf-32-le' if sys.byteorder == 'little' else 'utf-32-be'
+        return memoryview(text.encode(encoding, 'surrogatepass')).cast('I')
+
+    view = memoryview(text)
+    if view.format != 'B' or view.ndim != 1:
+        view = view.cast('B')
+    return view
+
 
 class Token(object):
     END = 0
@@ -182,8 +209,12 @@ class Tokenizer(object):
             return self.token
 
         token = self.tokenDict.get(s[self.index], None)
+        if token is not None:
+            # the token is changed below, don't change the one in the dict
+            token = Token(token.type, token.value)
+
         if token is None:
-            token = Token(Token.CHAR, readUtf8(s[self.index]))
+            token = Token(Token.CHAR, ord(s[self.index]))
             token.pos = self.index
             self.index += 1
 
@@ -212,7 +243,7 @@ class Tokenizer(object):
                 token = Token(Token.CHAR, readUnicode(s[self.index+2:self.index+6]), self.index)
                 self.index += 6
             else:
-                token = Token(Token.CHAR, readUtf8(s[self.index+1]), self.index)
+                token = Token(Token.CHAR, ord(s[self.index+1]), self.index)
                 self.index += 2
 
         # tokenizer can not tell whether the hyphen is
@@ -231,25 +262,52 @@ class Tokenizer(object):
 
 
 class Range(object):
+    """ Range is a character class, the ranges are sorted and merged
+    into disjoint intervals when it's built and the negation is folded
+    in, so negate is always False. an ASCII character is looked up in a
+    128-bit bitmap, the others by a binary search of the intervals.
+    """
     def __init__(self, ranges:list[tuple]=None, negate=False):
-        self.ranges = ranges or []
-        self.negate = negate
+        self.ranges = Range.normalize(ranges or [], negate)
+        self.negate = False
+        self.starts = [lo for lo, _ in self.ranges]
+        self.ends = [hi for _, hi in self.ranges]
+        self.ascii = 0
+        for lo, hi in self.ranges:
+            if lo < 128:
+                hi = min(hi, 127)
+                self.ascii |= ((1 << (hi - lo + 1)) - 1) << lo
 
     def __repr__(self) -> str:
         return str(self.ranges)
 
-    def match(self, c):
-        if not self.negate:
-            for r in self.ranges:
-                if r[0] <= c <= r[1]:
-                    return True
-            return False
-        
-        # negation
-        for r in self.ranges:
-            if r[0] <= c <= r[1]:
-                return False
-        return True
+    @staticmethod
+    def normalize(ranges:list[tuple], negate:bool) -> list[tuple]:
+        merged = []
+        for lo, hi in sorted(ranges):
+            if len(merged) > 0 and lo <= merged[-1][1] + 1:
+                if hi > merged[-1][1]:
+                    merged[-1] = (merged[-1][0], hi)
+            else:
+                merged.append((lo, hi))
+        if not negate:
+            return merged
+
+        complement = []
+        lo = 0
+        for start, end in merged:
+            if start > lo:
+                complement.append((lo, start - 1))
+            lo = end + 1
+        if lo <= sys.maxunicode:
+            complement.append((lo, sys.maxunicode))
+        return complement
+
+    def match(self, c:int) -> bool:
+        if c < 128:
+            return (self.ascii >> c) & 1 == 1
+        i = bisect_right(self.starts, c) - 1
+        return i >= 0 and c <= self.ends[i]
 
 
 class NFAAnchor:
@@ -259,6 +317,22 @@ class NFAAnchor:
     NWBOUND = 3 # non-word boundary
 
 
+# the anchor context a closure is computed in, the closure of a state
+# only depends on whether the position is at the begin or the end of text
+CTX_NONE = 0
+CTX_BEGIN = 1
+CTX_END = 2
+
+
+def textContext(pos:int, size:int) -> int:
+    ctx = CTX_NONE
+    if pos == 0:
+        ctx |= CTX_BEGIN
+    if pos == size:
+        ctx |= CTX_END
+    return ctx
+
+
 class NFAArc(object):
     """ NFAArc represent the arcs connecting to the nextN States,
     value is diffent according to different type. if type is 
@@ -268,6 +342,11 @@ class NFAArc(object):
         3) ANCHOR, value is NFAAnchor
         4) CHAR, value is a single character
         5) CLASS, value is a Range object
+        6) RESET, value is the counter, which is set to 0
+        7) INCR, value is the counter, which is increased
+        8) LOOP, value is the counter, taken if it's less than the max
+        9) EXIT, value is the counter, taken if it's not less than the
+           min, the counter is set to 0 again
     """
     EPSILON = 0
     LGROUP = 1
@@ -275,6 +354,10 @@ class NFAArc(object):
     ANCHOR = 3
     CHAR = 4
     CLASS = 5
+    RESET = 6
+    INCR = 7
+    LOOP = 8
+    EXIT = 9
 
     def __init__(self, target:NFAState=None,
                  value:t.Union[int, str, Range]=None, type_:int=0):
@@ -324,20 +407,6 @@ class NFAState(object):
         filter = {state}
         NFAState._closure(state, result, filter)
         return result
-    
-    def __hash__(self):
-        # assert(self._index is not None)
-        return self.index
-
-    def __eq__(self, state:NFAState):
-        # __eq__ can be used to simplify the states
-        if len(self.arcs) != len(state.arcs):
-            return False
-        
-        for i in range(len(self.arcs)):
-            if self.arcs[i] != state.arcs[i]:
-                return False
-        return True
 
 
 class NFA(object):
@@ -346,6 +415,7 @@ class NFA(object):
         self.end = None
         self.nodes = []
         self.groups = 0
+        self.repeats = [] # (min, max) of the counters
     
     def newState(self) -> NFAState:
         state = NFAState()
@@ -354,26 +424,22 @@ class NFA(object):
         return state
     
     def serialize(self, start, debug:bool=False) -> list[NFAState]:
-        """ Serialize the NFS states into a list. """
+        """ Serialize the NFA states into a list in BFS order. states are
+        told apart by identity, so it's linear in the number of arcs.
+        """
         todo = [start]
+        index = {id(start): 0}
 
         for i, state in enumerate(todo):
-            # set index to the state, index will be used in hashing
+            # set index to the state, index is used by copyFragment/lower
             state.index = i
             if debug: 
                 print("  State", i, state is self.end and "(final)" or "")
             for arc in state.arcs:
                 next = arc.target
-                if next in todo:
-                    j = todo.index(next)
-
-                    # XXX: there's a trap here, because of the __eq__, 
-                    # next may not equal to todo[j], must fix the arc to 
-                    # point to the correct state
-                    if next.index != todo[j].index:
-                        arc.target = todo[j]
-                else:
-                    j = len(todo)
+                j = index.get(id(next))
+                if j is None:
+                    j = index[id(next)] = len(todo)
                     todo.append(next)
                 if debug:
                     if arc.type == NFAArc.EPSILON:
@@ -389,16 +455,78 @@ class NFA(object):
                     elif arc.type == NFAArc.CHAR:
                         print("    %s -> %d" % (chr(arc.value), j))
                     elif arc.type == NFAArc.CLASS:
-                        if not arc.value.negate:
-                            print("    %s -> %d" % (arc.value, j))
-                        else:
-                            print("    ! %s -> %d" % (arc.value, j))
+                        print("    %s -> %d" % (arc.value, j))
+                    elif arc.type >= NFAArc.RESET:
+                        op = ('=0', '++', '<', '>=')[arc.type - NFAArc.RESET]
+                        print("    #%d%s -> %d" % (arc.value, op, j))
 
         if debug:
             print("")
 
         return todo
 
+    def optimize(self, start:NFAState, end:NFAState) -> NFAState:
+        """ optimize shrinks the graph reachable from start: the states
+        with a single ε arc are bypassed, the states with the same arcs
+        are merged, and the states can't be reached any more are dropped
+        when it's serialized again. the new start state is returned.
+        """
+        nodes = self.serialize(start)
+
+        # bypass the states with a single ε arc, a cycle of them can't
+        # match anything, it's cut at the state it is entered from.
+        forward = {}
+        for state in nodes:
+            if state is not end and len(state.arcs) == 1 and \
+               state.arcs[0].type == NFAArc.EPSILON:
+                forward[id(state)] = state.arcs[0].target
+
+        resolved = {}
+        def resolve(state:NFAState) -> NFAState:
+            path = {}
+            while id(state) in forward and id(state) not in resolved:
+                if id(state) in path:
+                    break
+                path[id(state)] = state
+                state = forward[id(state)]
+            state = resolved.get(id(state), state)
+            resolved.update(dict.fromkeys(path, state))
+            return state
+
+        start = resolve(start)
+        for state in nodes:
+            for arc in state.arcs:
+                arc.target = resolve(arc.target)
+
+        # merge the states with the same arcs until nothing changes,
+        # each round merges the states one more step from the end.
+        while True:
+            nodes = self.serialize(start)
+            same = {}
+            merged = {}
+            for state in nodes:
+                key = (state.accept, tuple(NFA.arcKey(arc) for arc in state.arcs))
+                other = same.setdefault(key, state)
+                if other is not state:
+                    merged[id(state)] = other
+            if not merged:
+                break
+            start = merged.get(id(start), start)
+            for state in nodes:
+                for arc in state.arcs:
+                    arc.target = merged.get(id(arc.target), arc.target)
+
+        for state in nodes:
+            state.index = None
+        return start
+
+    @staticmethod
+    def arcKey(arc:NFAArc) -> tuple:
+        value = arc.value
+        if arc.type == NFAArc.CLASS:
+            value = (tuple(value.ranges), value.negate)
+        return (arc.type, value, id(arc.target))
+
     def star(self, a:NFAState, z:NFAState) -> tuple[NFAState, NFAState]:
         z1 = self.newState()
         a.appendArc(z1, None, NFAArc.EPSILON)
@@ -435,6 +563,44 @@ class NFA(object):
         a.prependArc(z, None, NFAArc.EPSILON)
         return a, z
 
+    def nullable(self, a:NFAState, z:NFAState) -> bool:
+        """ nullable tells whether z can be reached from a without
+        consuming any character.
+        """
+        todo = [a]
+        seen = {id(a)}
+        while todo:
+            state = todo.pop()
+            if state is z:
+                return True
+            for arc in state.arcs:
+                if arc.type not in (NFAArc.CHAR, NFAArc.CLASS) and \
+                   id(arc.target) not in seen:
+                    seen.add(id(arc.target))
+                    todo.append(arc.target)
+        return False
+
+    def counted(self, a:NFAState, z:NFAState, lo:int, hi:t.Optional[int],
+                greedy:bool) -> tuple[NFAState, NFAState]:
+        """ counted repeats the fragment with a counter instead of copies
+        of it, the counter is the number of times the fragment has been
+        matched when the loop state is reached.
+        """
+        k = len(self.repeats)
+        self.repeats.append((lo, hi))
+        start = self.newState()
+        loop = self.newState()
+        end = self.newState()
+        start.appendArc(loop, k, NFAArc.RESET)
+        if greedy:
+            loop.appendArc(a, k, NFAArc.LOOP)
+            loop.appendArc(end, k, NFAArc.EXIT)
+        else:
+            loop.appendArc(end, k, NFAArc.EXIT)
+            loop.appendArc(a, k, NFAArc.LOOP)
+        z.appendArc(loop, k, NFAArc.INCR)
+        return start, end
+
     def copyFragment(self, ol:list[NFAState], z:NFAState) -> \
             tuple[NFAState, NFAState]:
         
@@ -455,101 +621,1457 @@ class NFA(object):
         return (nl[0], nl[z.index])
 
 
+class Program(object):
+    """ Program is the flat form of a compiled NFA, all the matchers
+    run on it. the arcs of state i are arcs first[i] to first[i+1]-1,
+    the opcode, operand and target state of arc j are types[j], 
+    values[j] and targets[j]. the operand of a CLASS arc is an index
+    to classes, identical classes are stored once.
+
+    closures[ctx][i] are the consuming arcs can be reached from state i
+    in the anchor context ctx, as (ops, type, value, target) tuples. a
+    closure is computed when it's first looked up, a program without
+    anchors shares the tables of the contexts which only differ by them.
+
+    tags maps the accept states to the index of their pattern, a program
+    made by union has one accept state per pattern and no accept.
+
+    the code points the program can't tell apart are in the same class
+    of its alphabet, c is in class pages[top[c >> 8]][c & 0xff]. top
+    ends at the block of the last bound, the blocks after it have the
+    page rest.
+
+    repeats[k] is the (min, max) of the counter k. in a program with
+    counters, the matchers run on configurations, a state and the values
+    of the counters, instead of states: a configuration whose counters
+    are all 0 is the index of its state, the others are numbered from
+    len(program) on when they are first reached. a search may reach one
+    configuration per state and value of a counter, O(n*max) of them for
+    a text of n characters, and walk as many at each position. their
+    memory is estimated in configMemory, RegExp.renew starts over with a
+    fresh copy of the program when it's over the budget.
+    """
+    # about the bytes of a configuration and of a closure entry, on CPython
+    CONFIG_BYTES = 200
+    ENTRY_BYTES = 80
+
+    def __init__(self):
+        self.first = array('l', [0])
+        self.types = array('B')
+        self.values = array('l')
+        self.targets = array('l')
+        self.classes = []
+        self.start = 0
+        self.accept = 0
+        self.tags = {0: 0}
+        self.groups = 0
+        self.closures = None
+        self.prefix = ()        # code points every match starts with
+        self.firstChars = None  # or the few code points it may start with
+        self.required = ()      # literals every match contains
+        self.alphabetSize = 1
+        self.top = None
+        self.pages = None
+        self.rest = 0
+        self.repeats = []
+        self.onepass = False
+        self.zeros = ()     # the counters of the states
+        self.configs = []   # configuration len(self) + i is configs[i]
+        self.configIds = {}
+        self.configMemory = 0
+        self.lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.first) - 1
+
+    @staticmethod
+    def lower(nodes:list[NFAState], end:NFAState, groups:int, 
+              repeats:list[tuple]=()) -> Program:
+        """ lower turns the serialized NFA states into a program. """
+        prog = Program()
+        classIndex = {}
+
+        for state in nodes:
+            for arc in state.arcs:
+                value = arc.value
+                if arc.type == NFAArc.CLASS:
+                    key = (tuple(value.ranges), value.negate)
+                    if key not in classIndex:
+                        classIndex[key] = len(prog.classes)
+                        prog.classes.append(value)
+                    value = classIndex[key]
+                elif value is None:
+                    value = 0
+                prog.types.append(arc.type)
+                prog.values.append(value)
+                prog.targets.append(arc.target.index)
+            prog.first.append(len(prog.types))
+
+        prog.accept = end.index
+        prog.tags = {prog.accept: 0}
+        prog.groups = groups
+        prog.repeats = list(repeats)
+        prog.analyze()
+        return prog
+
+    @staticmethod
+    def union(progs:list[Program]) -> Program:
+        """ union joins the programs into one, the new start state has
+        an ε arc to the start of each program in order, and the accept
+        state of the k-th program is tagged k.
+        """
+        prog = Program()
+        classIndex = {}
+        offset = 1
+        for p in progs:
+            prog.types.append(NFAArc.EPSILON)
+            prog.values.append(0)
+            prog.targets.append(p.start + offset)
+            offset += len(p)
+        prog.first.append(len(prog.types))
+
+        prog.tags = {}
+        offset = 1
+        for k, p in enumerate(progs):
+            counters = len(prog.repeats)
+            prog.repeats += p.repeats
+            for i in range(len(p)):
+                for j in range(p.first[i], p.first[i+1]):
+                    type_, value, target = p.arc(j)
+                    if type_ == NFAArc.CLASS:
+                        key = (tuple(value.ranges), value.negate)
+                        if key not in classIndex:
+                            classIndex[key] = len(prog.classes)
+                            prog.classes.append(value)
+                        value = classIndex[key]
+                    elif type_ >= NFAArc.RESET:
+                        value += counters
+                    prog.types.append(type_)
+                    prog.values.append(value)
+                    prog.targets.append(target + offset)
+                prog.first.append(len(prog.types))
+            prog.tags[p.accept + offset] = k
+            offset += len(p)
+
+        prog.accept = -1
+        prog.analyze()
+        return prog
+
+    def analyze(self) -> None:
+        """ analyze sets up the closures and computes the literals. """
+        self.zeros = (0,) * len(self.repeats)
+        self.closures = self.newClosures()
+        self.prefix, self.firstChars = self.literals()
+        self.required = self.factors()
+        self.alphabetSize, self.top, self.pages, self.rest = \
+            self.alphabet()
+        self.onepass = self.isOnePass()
+
+    def newClosures(self) -> list[Closures]:
+        if NFAArc.ANCHOR in self.types:
+            return [Closures(self, ctx) for ctx in
+                    range((CTX_BEGIN | CTX_END) + 1)]
+        # the beginning of the text makes no difference
+        none, end = Closures(self, CTX_NONE), Closures(self, CTX_END)
+        return [none, none, end, end]
+
+    def renew(self) -> Program:
+        """ renew returns a copy of the program without the closures and
+        the configurations reached so far, the searches running on this
+        one are not disturbed.
+        """
+        prog = Program.__new__(Program)
+        prog.__dict__.update(self.__dict__)
+        prog.configs = []
+        prog.configIds = {}
+        prog.configMemory = 0
+        prog.lock = threading.Lock()
+        prog.closures = prog.newClosures()
+        return prog
+
+    def isOnePass(self) -> bool:
+        """ isOnePass tells whether at most one arc of each closure can
+        take any character, then a match anchored at a position is found
+        by a single thread. all the arcs of a closure are checked, even
+        the ones after the accept state, which fullmatch may still take.
+        """
+        if len(self.repeats) > 0 or self.accept < 0:
+            return False
+
+        states = {self.start}
+        for j in range(len(self.types)):
+            if self.types[j] in (NFAArc.CHAR, NFAArc.CLASS):
+                states.add(self.targets[j])
+
+        for closures in self.closures:
+            for state in states:
+                intervals = []
+                for _, type_, value, _ in closures[state]:
+                    if type_ == NFAArc.CHAR:
+                        intervals.append((value, value))
+                    elif type_ == NFAArc.CLASS:
+                        intervals += value.ranges
+                intervals.sort()
+                last = -1
+                for lo, hi in intervals:
+                    if lo <= last:
+                        return False
+                    last = max(last, hi)
+        return True
+
+    def pack(self) -> tuple:
+        """ pack returns the program as a tuple marshal can dump, only 
+        the arrays and the class table are kept.
+        """
+        arrays = tuple((a.typecode, a.itemsize, a.tobytes()) for a in
+                       (self.first, self.types, self.values, self.targets))
+        classes = tuple((tuple(r.ranges), r.negate) for r in self.classes)
+        return (sys.byteorder, arrays, classes, 
+                self.start, self.accept, self.groups, tuple(self.repeats))
+
+    @staticmethod
+    def unpack(packed:tuple) -> Program:
+        byteorder, arrays, classes, start, accept, groups, repeats = packed
+        prog = Program()
+        buffers = []
+        for typecode, itemsize, data in arrays:
+            a = array(typecode)
+            if a.itemsize != itemsize:
+                raise ValueError(f'array {typecode!r} has a different size')
+            a.frombytes(data)
+            if byteorder != sys.byteorder:
+                a.byteswap()
+            buffers.append(a)
+
+        prog.first, prog.types, prog.values, prog.targets = buffers
+        prog.classes = [Range(list(ranges), negate) 
+                        for ranges, negate in classes]
+        prog.start = start
+        prog.accept = accept
+        prog.tags = {accept: 0}
+        prog.groups = groups
+        prog.repeats = list(repeats)
+        prog.analyze()
+        return prog
+
+    def literals(self) -> tuple[tuple, t.Optional[frozenset]]:
+        """ literals returns the literal prefix of the program, if there
+        is none, the set of characters a match can start with if they
+        are only a few.
+        """
+        prefix = []
+        visited = set()
+        index = self.start
+
+        while index not in visited and len(prefix) < LiteralScanner.MAX_PREFIX:
+            visited.add(index)
+            # the arcs can be taken at any position
+            entries = set()
+            for closure in self.closures:
+                for _, type_, value, target in closure[index]:
+                    if type_ != NFAArc.CHAR:
+                        entries = None
+                        break
+                    entries.add((value, target))
+                if entries is None:
+                    break
+            if entries is None or len(entries) != 1:
+                break
+            value, index = entries.pop()
+            prefix.append(value)
+
+        if len(prefix) > 0:
+            return tuple(prefix), None
+
+        chars = set()
+        for closure in self.closures:
+            for _, type_, value, _ in closure[self.start]:
+                if type_ != NFAArc.CHAR:
+                    return (), None
+                chars.add(value)
+        if 0 < len(chars) <= LiteralScanner.MAX_CHARS:
+            return (), frozenset(chars)
+        return (), None
+
+    def alphabet(self) -> tuple[int, array, list[array], int]:
+        """ alphabet splits the code points at the bounds of the CHAR
+        and CLASS arcs, and gives the same class to the intervals which
+        all the arcs take or refuse together. the map has a page of 256
+        classes for each block of code points up to the last bound, a
+        block in one interval shares the page of the class with the
+        others, and so do all the blocks after the last bound.
+        """
+        chars = {self.values[j] for j in range(len(self.types))
+                 if self.types[j] == NFAArc.CHAR}
+        bounds = {0}
+        for c in chars:
+            bounds.update((c, c + 1))
+        for r in self.classes:
+            for lo, hi in r.ranges:
+                bounds.update((lo, hi + 1))
+        bounds = sorted(b for b in bounds if b <= sys.maxunicode)
+
+        colors = {}
+        top = array('H', bytes(2 * ((bounds[-1] >> 8) + 1)))
+        pages = []
+        uniform = {}
+        rest = 0
+        for i, lo in enumerate(bounds):
+            hi = bounds[i+1] - 1 if i + 1 < len(bounds) else sys.maxunicode
+            key = (lo if lo in chars else -1, 
+                   tuple(r.match(lo) for r in self.classes))
+            color = colors.setdefault(key, len(colors))
+
+            # the blocks the interval covers, then the two partial ones
+            full = range((lo + 0xff) >> 8, (hi + 1) >> 8)
+            if len(full) > 0:
+                if color not in uniform:
+                    uniform[color] = len(pages)
+                    pages.append(array('H', [color]) * 256)
+                stop = min(full.stop, len(top))
+                if full.start < stop:
+                    top[full.start:stop] = \
+                        array('H', [uniform[color]]) * (stop - full.start)
+                if full.stop > len(top):
+                    rest = uniform[color]
+            for block in {lo >> 8, hi >> 8}:
+                if block in full or block >= len(top):
+                    continue
+                first = max(lo, block << 8) & 0xff
+                last = min(hi, (block << 8) | 0xff) & 0xff
+                if first == 0:
+                    # the first interval in the block
+                    top[block] = len(pages)
+                    pages.append(array('H', bytes(512)))
+                page = pages[top[block]]
+                page[first:last+1] = array('H', [color]) * (last - first + 1)
+
+        return len(colors), top, pages, rest
+
+    def classOf(self, c:int) -> int:
+        """ classOf returns the class of the code point c. """
+        block = c >> 8
+        page = self.top[block] if block < len(self.top) else self.rest
+        return self.pages[page][c & 0xff]
+
+    def arc(self, j:int) -> tuple[int, t.Union[int, Range], int]:
+        type_ = self.types[j]
+        value = self.values[j]
+        if type_ == NFAArc.CLASS:
+            value = self.classes[value]
+        return type_, value, self.targets[j]
+
+    def expand(self, index:int, ctx:int) -> list[tuple]:
+        """ expand returns the consuming arcs can be reached from the
+        configuration by ε transitions in priority order, ops are the 
+        (LGROUP/RGROUP, group) actions taken on the way. if the accept 
+        state is reached, an ε arc to it is in the list.
+
+        the arcs are walked in the same order as the BFS matching did,
+        a configuration is visited once, an anchor which does not hold
+        in the context is not followed.
+        """
+        if index in self.tags:
+            return [((), NFAArc.EPSILON, None, index)]
+
+        first = self.first
+        entries = []
+        visited = set()
+        state, counts = self.config(index)
+        stack = [(iter(range(first[state], first[state+1])), (), counts)]
+
+        while stack:
+            arcs, ops, counts = stack[-1]
+            j = next(arcs, None)
+            if j is None:
+                stack.pop()
+                continue
+
+            type_, value, target = self.arc(j)
+            if type_ in (NFAArc.CHAR, NFAArc.CLASS):
+                if not ctx & CTX_END:
+                    target = self.configId(target, counts)
+                    entries.append((ops, type_, value, target))
+                continue
+
+            if type_ >= NFAArc.RESET:
+                counts = self.count(type_, value, counts)
+                if counts is None:
+                    continue
+
+            if type_ == NFAArc.ANCHOR:
+                if not (value == NFAAnchor.START and ctx & CTX_BEGIN or
+                        value == NFAAnchor.END and ctx & CTX_END):
+                    continue
+
+            # LGROUP,RGROUP are also consider to be epsilon transitions
+            if (target, counts) in visited:
+                continue
+            visited.add((target, counts))
+
+            if type_ in (NFAArc.LGROUP, NFAArc.RGROUP):
+                ops += ((type_, value),)
+
+            if target in self.tags:
+                # the rest are not considered a candidate, unless the
+                # match has to end somewhere else (fullmatch)
+                entries.append((ops, NFAArc.EPSILON, None, target))
+                continue
+            stack.append((iter(range(first[target], first[target+1])), 
+                          ops, counts))
+
+        return entries
+
+    def config(self, index:int) -> tuple[int, tuple]:
+        """ config returns the state and the counters of a configuration. """
+        if index < len(self):
+            return index, self.zeros
+        return self.configs[index - len(self)]
+
+    def configId(self, state:int, counts:tuple) -> int:
+        if counts == self.zeros:
+            return state
+        index = self.configIds.get((state, counts))
+        if index is None:
+            with self.lock:
+                index = self.configIds.setdefault((state, counts), 
+                    len(self) + len(self.configs))
+                if index == len(self) + len(self.configs):
+                    self.configs.append((state, counts))
+                    self.configMemory += self.CONFIG_BYTES + 8 * len(counts)
+        return index
+
+    # the arcs walked backwards are taken as the ones they undo
+    BACKWARD = {NFAArc.RESET: NFAArc.EXIT, NFAArc.EXIT: NFAArc.RESET,
+                NFAArc.INCR: NFAArc.LOOP, NFAArc.LOOP: NFAArc.INCR}
+
+    def count(self, type_:int, k:int, counts:tuple, 
+              backward:bool=False) -> t.Optional[tuple]:
+        """ count returns the counters after the counter arc, or None if
+        it can't be taken. without a max, the counter stops at the min,
+        which is all an EXIT arc tells apart.
+        """
+        if backward:
+            type_ = Program.BACKWARD[type_]
+        lo, hi = self.repeats[k]
+        n = counts[k]
+        if type_ == NFAArc.RESET:
+            n = 0
+        elif type_ == NFAArc.INCR:
+            n = n + 1 if hi is not None else min(n + 1, lo)
+        elif type_ == NFAArc.LOOP:
+            return counts if hi is None or n < hi else None
+        elif n < lo:
+            return None
+        else:
+            n = 0
+        return counts[:k] + (n,) + counts[k+1:]
+
+    def dominators(self) -> list[int]:
+        """ dominators returns the states every path from the start
+        state to the accept state goes through, in the order of the
+        paths. (Cooper, Harvey and Kennedy's algorithm)
+        """
+        n = len(self)
+        preds = [[] for _ in range(n)]
+        order = []
+        visited = {self.start}
+        stack = [(self.start, iter(range(self.first[self.start],
+                                         self.first[self.start+1])))]
+        while stack:
+            index, arcs = stack[-1]
+            j = next(arcs, None)
+            if j is None:
+                order.append(index)
+                stack.pop()
+                continue
+            target = self.targets[j]
+            preds[target].append(index)
+            if target not in visited:
+                visited.add(target)
+                stack.append((target, iter(range(self.first[target],
+                                                 self.first[target+1]))))
+
+        if self.accept not in visited:
+            return []
+
+        order.reverse()
+        rpo = {index: i for i, index in enumerate(order)}
+        idom = {self.start: self.start}
+
+        def intersect(a, b):
+            while a != b:
+                while rpo[a] > rpo[b]:
+                    a = idom[a]
+                while rpo[b] > rpo[a]:
+                    b = idom[b]
+            return a
+
+        changed = True
+        while changed:
+            changed = False
+            for index in order[1:]:
+                new = None
+                for p in preds[index]:
+                    if p in idom:
+                        new = p if new is None else intersect(p, new)
+                if idom.get(index) != new:
+                    idom[index] = new
+                    changed = True
+
+        result = [self.accept]
+        while result[-1] != self.start:
+            result.append(idom[result[-1]])
+        result.reverse()
+        return result
+
+    def factors(self) -> tuple[tuple, ...]:
+        """ factors returns the literals every match contains, they are
+        made of the CHAR arcs between the dominators of the accept state
+        which are the only way out of their state.
+        """
+        literals = []
+        literal = []
+        for index in self.dominators():
+            j = self.first[index]
+            type_ = self.types[j] if self.first[index+1] == j + 1 else None
+            if type_ == NFAArc.CHAR:
+                literal.append(self.values[j])
+            elif type_ not in (NFAArc.EPSILON, NFAArc.LGROUP, 
+                               NFAArc.RGROUP, NFAArc.ANCHOR):
+                if len(literal) > 0:
+                    literals.append(tuple(literal))
+                literal = []
+
+        # the longest ones reject most, drop those contained in others
+        literals.sort(key=len, reverse=True)
+        result = []
+        for literal in literals:
+            s = ''.join(map(chr, literal))
+            if not any(s in ''.join(map(chr, r)) for r in result):
+                result.append(literal)
+        return tuple(result[:LiteralScanner.MAX_FACTORS])
+
+    def sizeof(self) -> int:
+        """ sizeof returns the bytes used by the program now: the arrays,
+        the classes, the alphabet map, the closures computed so far and
+        the counter configurations reached. an object shared by several
+        of them is counted once.
+        """
+        size = 0
+        seen = set()
+        todo = [self]
+        while todo:
+            obj = todo.pop()
+            if id(obj) in seen:
+                continue
+            seen.add(id(obj))
+            size += sys.getsizeof(obj)
+            if isinstance(obj, dict):
+                todo += obj.keys()
+                todo += obj.values()
+            elif isinstance(obj, (list, tuple, set, frozenset)):
+                todo += obj
+            if hasattr(obj, '__dict__') and not isinstance(obj, type):
+                todo.append(obj.__dict__)
+        return size
+
+
+class Closures(dict):
+    """ Closures are the closures of the states, or configurations, of
+    a program in a context, each one is computed when it's first looked
+    up, so only the ones a search reaches are paid for.
+    """
+    def __init__(self, prog:Program, ctx:int):
+        super().__init__()
+        self.prog = prog
+        self.ctx = ctx
+
+    def __missing__(self, index:int) -> list[tuple]:
+        prog = self.prog
+        closure = self[index] = prog.expand(index, self.ctx)
+        if index >= len(prog):
+            prog.configMemory += prog.ENTRY_BYTES * (len(closure) + 1)
+        return closure
+
+
+class LiteralScanner(object):
+    """ LiteralScanner finds the next position a match may start at,
+    using the find method of the text which is implemented in C.
+    """
+    MAX_CHARS = 8
+    MAX_FACTORS = 4
+    MAX_PREFIX = 256
+
+    def __init__(self, text, needles:list, endpos:int=None):
+        self.text = text
+        self.needles = needles
+        self.found = [-1] * len(needles)
+        self.endpos = len(text) if endpos is None else endpos
+
+    @staticmethod
+    def create(text, prog:Program, 
+               endpos:int=None) -> t.Optional[LiteralScanner]:
+        """ create returns None if there is nothing to look for or the
+        text can not be searched, the text is searched up to endpos.
+        """
+        if not hasattr(text, 'find'):
+            return None
+        if len(prog.prefix) > 0:
+            literals = [prog.prefix]
+        elif prog.firstChars is not None:
+            literals = [(c,) for c in sorted(prog.firstChars)]
+        else:
+            return None
+
+        needles = []
+        for literal in literals:
+            needle = LiteralScanner.needle(text, literal)
+            # else the literal can never appear in the bytes
+            if needle is not None:
+                needles.append(needle)
+        return LiteralScanner(text, needles, endpos)
+
+    @staticmethod
+    def needle(text, literal:tuple) -> t.Union[str, bytes, None]:
+        if isinstance(text, str):
+            return ''.join(map(chr, literal))
+        if max(literal) < 256:
+            return bytes(literal)
+        return None
+
+    @staticmethod
+    def prefilter(text, prog:Program, pos:int=0, endpos:int=None) -> bool:
+        """ prefilter returns False if one of the literals required by
+        the program is not in the text between pos and endpos. every
+        literal is looked up by the find method of the text, which is
+        faster than any scanner for several literals written in python.
+        """
+        if len(prog.required) == 0 or not hasattr(text, 'find'):
+            return True
+        if endpos is None:
+            endpos = len(text)
+        for literal in prog.required:
+            needle = LiteralScanner.needle(text, literal)
+            if needle is None or text.find(needle, pos, endpos) < 0:
+                return False
+        return True
+
+    def next(self, pos:int) -> int:
+        """ next returns the first candidate not before pos, or -1. """
+        result = -1
+        for i, needle in enumerate(self.needles):
+            found = self.found[i]
+            if found != -2 and found < pos:
+                found = self.text.find(needle, pos, self.endpos)
+                # -2: the needle does not occur any more
+                self.found[i] = found = found if found >= 0 else -2
+            if found >= 0 and (result < 0 or found < result):
+                result = found
+        return result
+
+
 class Thread(object):
-    """ use google re2's BFS matching algorithm
+    """ use google re2's BFS matching algorithm, the ε transitions
+    are not walked while matching but looked up in the closures
+    computed by RegExp.compile.
+
+    the groups are kept in a flat tuple of slots, slots[2*n] and
+    slots[2*n+1] are the start and end of group n. tuples are never
+    modified, so threads share them until a capture changes one.
     """
-    def __init__(self, id, state, text, pos, groups=None):
+    def __init__(self, id, state, text, pos, slots):
         self.id = id
         self.state = state
         self.text = text
         self.pos = pos
-        self.groups = groups or {0: [pos, None]}
+        self.slots = slots
 
-    def _advance(self, threads:list[Thread], visited:set) -> None:
-        state = self.state
+    @staticmethod
+    def capture(slots:tuple, ops:tuple, pos:int) -> tuple:
+        copied = None
+        for type_, group in ops:
+            if type_ == NFAArc.LGROUP:
+                # only record the first occurrence
+                index = 2 * group
+                if slots[index] is not None:
+                    continue
+            else:
+                assert(slots[2 * group] is not None)
+                index = 2 * group + 1
+                if slots[index]:
+                    continue
+            if copied is None:
+                copied = list(slots)
+                slots = copied
+            copied[index] = pos
+        return slots if copied is None else tuple(copied)
+
+    def accept(self, state:int, slots:tuple, pos:int) -> Thread:
+        slots = (slots[0], pos) + slots[2:]
+        return Thread(self.id, state, self.text, pos, slots)
+
+    def advance(self, prog:Program, anchorEnd:bool=False, 
+                notEmpty:int=-1, stop:int=None) -> list[Thread]:
+        """ advance returns the threads after the next character, if
+        anchorEnd is set, the accept state only counts at the end, and an
+        empty match at notEmpty does not count. no character is taken
+        at stop.
+        """
+        threads = []
+        pos = self.pos
+        text = self.text
+        closure = prog.closures[textContext(pos, len(text))][self.state]
+        c = text[pos] if pos < len(text) and pos != stop else None
+
+        for ops, type_, value, target in closure:
+            if type_ == NFAArc.EPSILON:
+                if anchorEnd and pos != len(text) or \
+                   pos == notEmpty and self.slots[0] == pos:
+                    continue
+                slots = Thread.capture(self.slots, ops, pos)
+                threads.append(self.accept(target, slots, pos))
+                break
 
-        if state.accept:
-            self.groups = copy.deepcopy(self.groups)
-            self.groups[0][1] = self.pos
-            threads.append(self)
-            return
+            if type_ == NFAArc.CHAR:
+                if value != c:
+                    continue
+            elif c is None or not value.match(c):
+                continue
 
-        for arc in state.arcs:
-            if len(threads) > 0 and threads[-1].state.accept:
-                return
+            if target == prog.accept:
+                if anchorEnd and pos + 1 != len(text):
+                    continue
+                slots = Thread.capture(self.slots, ops, pos)
+                threads.append(self.accept(target, slots, pos+1))
+                break
+            slots = Thread.capture(self.slots, ops, pos)
+            threads.append(Thread(self.id, target, text, pos+1, slots))
+        return threads
 
-            if arc.type == NFAArc.CHAR and self.pos < len(self.text):
-                if arc.value == readUtf8(self.text[self.pos]):
-                    th = self.copy(arc.target, pos=self.pos+1)
-                    if arc.target.accept:
-                        th.groups = copy.deepcopy(self.groups)
-                        th.groups[0][1] = self.pos + 1
-                    threads.append(th)
-                continue
 
-            elif arc.type == NFAArc.CLASS and self.pos < len(self.text):
-                char = readUtf8(self.text[self.pos])
-                if arc.value.match(char):
-                    th = self.copy(arc.target, pos=self.pos+1)
-                    if arc.target.accept:
-                        th.groups = copy.deepcopy(self.groups)
-                        th.groups[0][1] = self.pos + 1
-                    threads.append(th)
-                continue
+class Match(object):
+    """ Match is returned by a successful search, it keeps the capture
+    slots and only turns them into spans and strings when asked.
 
-            if arc.target in visited:
-                continue
-            else:
-                # before visit every epsilon transition
-                # add them to the visited set to avoid deadloop
-                # visiting. note that LGROUP,RGROUP are also 
-                # consider to be epsilon transitions!
-                
-                # e.g. consider the case '(a??)*' which there is
-                # a loop in the automata.
-                visited.add(arc.target)
+    the spans are positions in the whole text, string starts at base,
+    which is not 0 for the matches of a Stream.
+    """
+    def __init__(self, regexp:RegExp, string, pos:int, slots:tuple,
+                 base:int=0):
+        self.re = regexp
+        self.string = string
+        self.pos = pos
+        self.slots = slots
+        self.base = base
+
+    def __repr__(self) -> str:
+        return f'<re2.Match object; span={self.span()}, ' \
+               f'match={self.group()!r}>'
+
+    def __getitem__(self, group:int):
+        return self.group(group)
+
+    def span(self, group:int=0) -> tuple[int, int]:
+        if not 0 <= group < len(self.slots) // 2:
+            raise IndexError(f'no such group {group}')
+        start, end = self.slots[2*group], self.slots[2*group+1]
+        if start is None or end is None:
+            return -1, -1
+        return start, end
+
+    def start(self, group:int=0) -> int:
+        return self.span(group)[0]
+
+    def end(self, group:int=0) -> int:
+        return self.span(group)[1]
+
+    def group(self, *groups:int):
+        if len(groups) > 1:
+            return tuple(self.group(g) for g in groups)
+        start, end = self.span(groups[0] if groups else 0)
+        if start < 0:
+            return None
+        return self.string[start-self.base:end-self.base]
+
+    def groups(self, default=None) -> tuple:
+        result = []
+        for group in range(1, len(self.slots) // 2):
+            s = self.group(group)
+            result.append(default if s is None else s)
+        return tuple(result)
+
+    def spans(self) -> dict:
+        """ spans returns {group: [start, end]} of the groups which
+        have been captured, as RegExp.search does.
+        """
+        result = {}
+        for group in range(len(self.slots) // 2):
+            if self.slots[2*group] is not None:
+                result[group] = [self.slots[2*group], self.slots[2*group+1]]
+        return result
+
+
+class DFACacheFull(Exception):
+    """ raised when the state cache of a LazyDFA is flushed too often
+    to make progress, the caller should fall back to the NFA simulation.
+    """
+    pass
+
+
+DFACacheInfo = namedtuple('DFACacheInfo', ['states', 'memory', 'maxMemory',
+                                           'flushes'])
+
+
+class DFABudget(object):
+    """ DFABudget is the memory the lazy DFAs of all the patterns may take
+    together, so that the memory of a process which runs many patterns
+    stays bounded. each automaton reserves the bytes of the states it
+    builds, when the total would go over maxMemory the caches used the
+    longest time ago are flushed first. the automata are only held
+    weakly, the memory of a pattern which is gone is given back.
+    """
+    MAX_MEMORY = 128 << 20
+
+    def __init__(self, maxMemory:int=None):
+        self.maxMemory = self.MAX_MEMORY if maxMemory is None else maxMemory
+        self.memory = 0
+        self.caches = OrderedDict() # id -> [weakref, bytes], oldest first
+        self.flushes = 0
+        self.lock = threading.RLock() # a flush gives the memory back
+
+    def add(self, dfa:LazyDFA) -> None:
+        key = id(dfa)
+        ref = weakref.ref(dfa, lambda _: self.remove(key))
+        with self.lock:
+            self.caches[key] = [ref, 0]
+
+    def remove(self, key:int) -> None:
+        with self.lock:
+            entry = self.caches.pop(key, None)
+            if entry is not None:
+                self.memory -= entry[1]
+
+    def touch(self, dfa:LazyDFA) -> None:
+        with self.lock:
+            if id(dfa) in self.caches:
+                self.caches.move_to_end(id(dfa))
+
+    def reserve(self, dfa:LazyDFA, size:int) -> bool:
+        """ reserve adds size bytes to the memory of dfa, it flushes the
+        least recently used caches to make room. it returns False if
+        there is no room even then, only dfa itself can be flushed.
+        """
+        key = id(dfa)
+        with self.lock:
+            entry = self.caches.get(key)
+            if entry is None:
+                return True
+            self.caches.move_to_end(key)
+            for other in list(self.caches):
+                if self.memory + size <= self.maxMemory or other == key:
+                    break
+                ref, used = self.caches.get(other, (None, 0))
+                victim = ref() if ref is not None else None
+                if victim is not None and used > 0:
+                    victim.flush()
+                    self.flushes += 1
+            if self.memory + size > self.maxMemory:
+                return False
+            self.memory += size
+            entry[1] += size
+            return True
+
+    def release(self, dfa:LazyDFA) -> None:
+        with self.lock:
+            entry = self.caches.get(id(dfa))
+            if entry is not None:
+                self.memory -= entry[1]
+                entry[1] = 0
+
+    def resize(self, maxMemory:int) -> None:
+        with self.lock:
+            self.maxMemory = maxMemory
+            for key in list(self.caches):
+                if self.memory <= maxMemory:
+                    break
+                victim = self.caches[key][0]()
+                if victim is not None and self.caches[key][1] > 0:
+                    victim.flush()
+                    self.flushes += 1
+
+    def info(self) -> DFACacheInfo:
+        """ info returns the totals of the automata alive, flushes are
+        the caches flushed to make room for another one.
+        """
+        with self.lock:
+            dfas = [ref() for ref, _ in self.caches.values()]
+            dfas = [dfa for dfa in dfas if dfa is not None]
+            return DFACacheInfo(sum(len(dfa.states) for dfa in dfas),
+                                self.memory, self.maxMemory, self.flushes)
+
+
+dfaBudget = DFABudget()
+
+
+class DFAState(object):
+    """ DFAState is a deterministic state built from a set of NFA states,
+    next caches the transitions which have been computed so far.
+    """
+    def __init__(self, threads:t.Union[tuple, frozenset], start:bool, 
+                 size:int):
+        self.threads = threads
+        self.start = start # new threads are still added at the start state
+        self.next = [None] * size # by the class of the character
+
+
+class LazyDFA(object):
+    """ google re2's lazy DFA, the deterministic states are built on
+    demand from the NFA states and their transitions are cached, so that
+    the same transition is computed only once no matter how many times
+    it is taken.
+
+    the forward automaton mirrors the leftmost-first simulation of
+    RegExp.search: a state is the ordered list of NFA states the threads
+    are in, and it finds where the leftmost match ends.
+
+    the cache holds at most maxStates states taking maxMemory bytes, and
+    its memory counts against the budget shared by all the automata. when
+    it is full it's flushed and rebuilt. if it has to be flushed again
+    before enough text is scanned, DFACacheFull is raised.
+    """
+    # no match, a match ends before/after the current character
+    NOMATCH = 0
+    MATCH_BEFORE = 1
+    MATCH_AFTER = 2
+
+    MAX_STATES = 10000
+    MAX_MEMORY = 8 << 20
+    MIN_PROGRESS = 10 # characters to scan per state between two flushes
+    # about the bytes of a DFAState with its key in the cache, and of a
+    # cached transition, on CPython
+    STATE_BYTES = 320
+    TRANSITION_BYTES = 64
+
+    def __init__(self, prog:Program, maxStates:int=None, 
+                 maxMemory:int=None, budget:DFABudget=None):
+        self.prog = prog
+        self.maxStates = maxStates or self.MAX_STATES
+        self.maxMemory = maxMemory or self.MAX_MEMORY
+        self.budget = budget or dfaBudget
+        self.states = {}
+        self.memory = 0
+        self.flushes = 0
+        self.budget.add(self)
+
+    def reserve(self, size:int) -> None:
+        """ reserve counts size more bytes of cache, it raises 
+        DFACacheFull if the cache or the budget is full.
+        """
+        if self.memory + size > self.maxMemory or \
+           not self.budget.reserve(self, size):
+            raise DFACacheFull(f'{self.memory} bytes')
+        self.memory += size
+
+    def getState(self, threads, start:bool=False) -> DFAState:
+        key = (threads, start)
+        state = self.states.get(key)
+        if state is None:
+            if len(self.states) >= self.maxStates:
+                raise DFACacheFull(f'{len(self.states)} states')
+            self.reserve(self.STATE_BYTES + 8 * (len(threads) + 
+                                                 self.prog.alphabetSize))
+            state = self.states[key] = DFAState(threads, start, 
+                                                self.prog.alphabetSize)
+        return state
+
+    def flush(self) -> None:
+        for state in self.states.values():
+            state.next = [None] * self.prog.alphabetSize
+        self.states = {}
+        self.memory = 0
+        self.flushes += 1
+        self.budget.release(self)
+
+    def info(self) -> DFACacheInfo:
+        return DFACacheInfo(len(self.states), self.memory, self.maxMemory,
+                            self.flushes)
+
+    def step(self, state:DFAState, c:t.Optional[int], ctx:int) -> \
+            tuple[DFAState, int]:
+        """ step does what RegExp.search does at one position: advance
+        the threads in order, then try a new thread at the start state
+        unless a match has been found.
+        """
+        prog = self.prog
+        threads = state.threads
+        if state.start:
+            threads += (prog.start,)
+
+        out = []
+        seen = set()
+        kind = LazyDFA.NOMATCH
+        for index in threads:
+            for _, type_, value, target in prog.closures[ctx][index]:
+                if type_ == NFAArc.EPSILON:
+                    kind = LazyDFA.MATCH_BEFORE
+                    break
+                if c is None:
+                    continue
+                if type_ == NFAArc.CHAR:
+                    if value != c:
+                        continue
+                elif not value.match(c):
+                    continue
+                if target == prog.accept:
+                    kind = LazyDFA.MATCH_AFTER
+                    break
+                if target not in seen:
+                    seen.add(target)
+                    out.append(target)
+            if kind != LazyDFA.NOMATCH:
+                # threads after the matching one are not candidates
+                break
+
+        start = state.start and kind == LazyDFA.NOMATCH
+        return self.getState(tuple(out), start), kind
+
+    def transition(self, state:DFAState, c:t.Optional[int], ctx:int) -> \
+            tuple[DFAState, int]:
+        if ctx == CTX_NONE and c is not None:
+            # the characters of a class have the same transition
+            prog = self.prog
+            # prog.classOf(c) inline
+            block = c >> 8
+            k = prog.pages[prog.top[block] if block < len(prog.top) 
+                           else prog.rest][c & 0xff]
+            result = state.next[k]
+            if result is None:
+                result = self.step(state, c, ctx)
+                self.reserve(self.TRANSITION_BYTES)
+                state.next[k] = result
+            return result
+
+        # the anchor context only differs at both ends of the text,
+        # don't cache those transitions.
+        return self.step(state, c, ctx)
+
+    def searchEnd(self, text:memoryview, pos:int=0,
+                  scanner:LiteralScanner=None, 
+                  stats:SearchStats=None) -> t.Optional[int]:
+        """ searchEnd returns where the leftmost match ends, or None
+        if the text does not match. 
+        
+        if a scanner is given, it skips to the next candidate whenever 
+        there is no thread alive.
+        """
+        self.budget.touch(self)
+        begin = pos
+        end = None
+        size = len(text)
+        lastFlush = None
+        state = initial = self.getState((), True)
+
+        while pos <= size:
+            if state is initial and scanner is not None:
+                pos = scanner.next(pos)
+                if pos < 0:
+                    break
+            ctx = textContext(pos, size)
+            c = text[pos] if pos < size else None
+            try:
+                state, kind = self.transition(state, c, ctx)
+            except DFACacheFull:
+                if lastFlush is not None and \
+                   pos - lastFlush < self.MIN_PROGRESS * len(self.states):
+                    raise
+                lastFlush = pos
+                self.flush()
+                state, kind = self.transition(state, c, ctx)
+
+            if kind == LazyDFA.MATCH_BEFORE:
+                end = pos
+            elif kind == LazyDFA.MATCH_AFTER:
+                end = pos + 1
+
+            if len(state.threads) == 0 and not state.start:
+                break
+            pos += 1
+
+        if stats is not None:
+            # the scanner skipped the rest of the text if pos < 0
+            stats.positions += (size if pos < 0 else min(pos, size)) - begin
+        return end
+
+
+class ReverseDFA(LazyDFA):
+    """ the reverse automaton runs the NFA arcs backwards from the end of
+    a match, the longest reversed match gives the leftmost start. there
+    is no priority in the reverse direction, so a state is just the set
+    of NFA states.
+    """
+    def __init__(self, prog:Program, maxStates:int=None, 
+                 maxMemory:int=None, budget:DFABudget=None):
+        super().__init__(prog, maxStates, maxMemory, budget)
+        self.expansions = {}
+        # rarcs[i] are the arcs into state i as (type, value, source)
+        self.rarcs = [[] for _ in range(len(prog))]
+        for i in range(len(prog)):
+            for j in range(prog.first[i], prog.first[i+1]):
+                type_, value, target = prog.arc(j)
+                self.rarcs[target].append((type_, value, i))
+
+    def flush(self) -> None:
+        super().flush()
+        self.expansions = {}
+
+    def expand(self, index:int, ctx:int) -> frozenset:
+        """ expand returns the configurations can be reached backwards
+        by ε transitions.
+        """
+        key = (index, ctx)
+        closure = self.expansions.get(key)
+        if closure is not None:
+            return closure
+
+        prog = self.prog
+        closure = {index}
+        todo = [index]
+        while todo:
+            state, counts = prog.config(todo.pop())
+            for type_, value, source in self.rarcs[state]:
+                if type_ in (NFAArc.CHAR, NFAArc.CLASS):
+                    continue
+                if type_ == NFAArc.ANCHOR and not \
+                   (value == NFAAnchor.START and ctx & CTX_BEGIN or
+                    value == NFAAnchor.END and ctx & CTX_END):
+                    continue
+                source = self.source(type_, value, source, counts)
+                if source is None or source in closure:
+                    continue
+                closure.add(source)
+                todo.append(source)
+
+        # the expansions are cached with the states and flushed with them
+        self.reserve(self.STATE_BYTES + 8 * len(closure))
+        closure = self.expansions[key] = frozenset(closure)
+        return closure
+
+    def source(self, type_:int, value:int, source:int, 
+               counts:tuple) -> t.Optional[int]:
+        """ source returns the configuration an arc comes from. """
+        if type_ >= NFAArc.RESET:
+            counts = self.prog.count(type_, value, counts, backward=True)
+            if counts is None:
+                return None
+        return self.prog.configId(source, counts)
+
+    def step(self, state:DFAState, c:t.Optional[int], ctx:int) -> \
+            tuple[DFAState, int]:
+        closure = set()
+        for index in state.threads:
+            closure |= self.expand(index, ctx)
+
+        out = set()
+        if c is not None:
+            for index in closure:
+                state_, counts = self.prog.config(index)
+                for type_, value, source in self.rarcs[state_]:
+                    if type_ == NFAArc.CHAR and value == c or \
+                       type_ == NFAArc.CLASS and value.match(c):
+                        out.add(self.prog.configId(source, counts))
+
+        if self.prog.start in closure:
+            kind = LazyDFA.MATCH_BEFORE
+        else:
+            kind = LazyDFA.NOMATCH
+        return self.getState(frozenset(out)), kind
+
+    def searchStart(self, text:memoryview, pos:int, end:int,
+                    stats:SearchStats=None) -> t.Optional[int]:
+        """ searchStart returns the leftmost position not before pos
+        where a match ending at end starts.
+        """
+        self.budget.touch(self)
+        begin = end
+        start = None
+        size = len(text)
+        lastFlush = None
+        state = self.getState(frozenset((self.prog.accept,)))
+
+        while end >= pos:
+            # the context of the position, not the character consumed
+            ctx = textContext(end, size)
+            c = text[end-1] if end > pos else None
+            try:
+                state, kind = self.transition(state, c, ctx)
+            except DFACacheFull:
+                if lastFlush is not None and \
+                   lastFlush - end < self.MIN_PROGRESS * len(self.states):
+                    raise
+                lastFlush = end
+                self.flush()
+                state, kind = self.transition(state, c, ctx)
+
+            if kind == LazyDFA.MATCH_BEFORE:
+                start = end
+            if len(state.threads) == 0:
+                break
+            end -= 1
+
+        if stats is not None:
+            stats.positions += begin - max(end, pos)
+        return start
+
+
+class SetDFA(LazyDFA):
+    """ the automaton of a RegexSet runs all the patterns at once, there
+    is no priority among them, so a state is just the set of NFA states
+    and a new thread is started at every position. step returns the tags
+    of the patterns matching at the position instead of a kind.
+    """
+    def step(self, state:DFAState, c:t.Optional[int], ctx:int) -> \
+            tuple[DFAState, frozenset]:
+        prog = self.prog
+        tags = set()
+        out = set()
+        for index in state.threads | {prog.start}:
+            for _, type_, value, target in prog.closures[ctx][index]:
+                if type_ == NFAArc.EPSILON:
+                    tags.add(prog.tags[target])
+                    continue
+                if c is None:
+                    continue
+                if type_ == NFAArc.CHAR:
+                    if value != c:
+                        continue
+                elif not value.match(c):
+                    continue
+                out.add(target)
+
+        return self.getState(frozenset(out), True), frozenset(tags)
+
+    def searchTags(self, text:memoryview, pos:int=0,
+                   scanner:LiteralScanner=None) -> set:
+        """ searchTags returns the tags of the patterns matching the text
+        after pos, the text is scanned once whatever the number of the
+        patterns is.
+        """
+        self.budget.touch(self)
+        found = set()
+        size = len(text)
+        lastFlush = None
+        state = initial = self.getState(frozenset(), True)
+
+        while pos <= size:
+            if state is initial and scanner is not None:
+                pos = scanner.next(pos)
+                if pos < 0:
+                    break
+            ctx = textContext(pos, size)
+            c = text[pos] if pos < size else None
+            try:
+                state, tags = self.transition(state, c, ctx)
+            except DFACacheFull:
+                if lastFlush is not None and \
+                   pos - lastFlush < self.MIN_PROGRESS * len(self.states):
+                    raise
+                lastFlush = pos
+                self.flush()
+                state, tags = self.transition(state, c, ctx)
+
+            found |= tags
+            if len(found) == len(self.prog.tags):
+                break
+            pos += 1
+
+        return found
+
+
+class Plan(object):
+    """ Plan is the engines a RegExp runs, chosen from its program when
+    it's compiled. the fields can be set to force another engine.
+
+        scan      how a match is found: 'anchored' only tries position 0,
+                  'literal' finds the literal the pattern is with the find
+                  method of the text, 'dfa' runs the lazy DFA forwards and
+                  the reverse DFA backwards, 'nfa' runs the threads over
+                  the whole text.
+        capture   how a match at a given position is found with its
+                  groups: 'onepass', 'backtrack' if the bitmap fits else
+                  'nfa', or 'nfa'. a scan which finds the span of the
+                  match only needs it if there are groups.
+
+    texts short enough to backtrack are backtracked instead of scanned,
+    unless capture is 'nfa'.
+    """
+    def __init__(self, prog:Program):
+        start = prog.start
+        self.anchored = prog.accept >= 0 and \
+            len(prog.closures[CTX_NONE][start]) == 0 and \
+            len(prog.closures[CTX_END][start]) == 0
+        self.literal = prog.groups == 0 and Plan.isLiteral(prog)
+
+        if self.anchored:
+            self.scan = 'anchored'
+        elif self.literal:
+            self.scan = 'literal'
+        elif any((hi or lo) > LazyDFA.MAX_STATES for lo, hi in prog.repeats):
+            # a counter needs more DFA states than the cache holds
+            self.scan = 'nfa'
+        else:
+            self.scan = 'dfa'
+
+        if prog.onepass:
+            self.capture = 'onepass'
+        elif len(prog.repeats) > 0:
+            self.capture = 'nfa'
+        else:
+            self.capture = 'backtrack'
+
+    @staticmethod
+    def isLiteral(prog:Program) -> bool:
+        """ isLiteral tells whether the program matches its literal prefix
+        and nothing else, in any context.
+        """
+        if len(prog.prefix) == 0 or prog.accept < 0:
+            return False
+        index = prog.start
+        for c in prog.prefix:
+            # nothing is taken at the end of the text
+            for ctx, closure in enumerate(prog.closures):
+                if ctx & CTX_END and len(closure[index]) > 0 or not \
+                   ctx & CTX_END and (len(closure[index]) != 1 or 
+                                      closure[index][0][0]):
+                    return False
+            index = prog.closures[CTX_NONE][index][0][3]
+        for closure in prog.closures:
+            if index != prog.accept and \
+               closure[index] != [((), NFAArc.EPSILON, None, prog.accept)]:
+                return False
+        return True
+
+    def cost(self, prog:Program) -> dict:
+        """ cost estimates the closure entries walked per character of the
+        text to find a match, and of the match to find its groups, in the
+        worst case.
+        """
+        entries = [len(prog.closures[CTX_NONE][i]) for i in range(len(prog))]
+        # a counter multiplies the configurations a state can be in
+        configs = max((hi or lo for lo, hi in prog.repeats), default=1)
+        entries = [n * configs for n in entries]
+        arcs = {'onepass': max(entries, default=0),
+                'backtrack': sum(entries), 'nfa': sum(entries)}
+        scan = {'anchored': 0, 'literal': 0, 'dfa': 1, 'nfa': sum(entries)}
+        capture = arcs[self.capture]
+        if prog.groups == 0 and self.scan in ('literal', 'dfa'):
+            capture = 0
+        return {'scan': scan[self.scan], 'capture': capture}
+
+
+class SearchStats(object):
+    """ SearchStats is the work one search did, it's given to the hook of
+    the pattern after the search:
+
+        positions    the positions the engines stepped over, a position
+                     tried from two starts counts twice
+        threads      the threads created, for the backtracker the entries
+                     pushed on its stack
+        closures     the closures walked
+        peakThreads  the most threads alive at once
+        copies       the slots copied to record a group or a match
+        times        the seconds spent in each phase: 'prefilter' checks
+                     the literals and decodes the text, 'scan' finds the
+                     match and 'capture' finds its groups
+
+    an engine which finds the match and its groups at once counts as scan.
+    """
+    PHASES = ('prefilter', 'scan', 'capture')
+
+    def __init__(self, pattern:str):
+        self.pattern = pattern
+        self.searches = 1
+        self.positions = 0
+        self.threads = 0
+        self.closures = 0
+        self.peakThreads = 0
+        self.copies = 0
+        self.times = dict.fromkeys(SearchStats.PHASES, 0.0)
+        self.phase = 'prefilter' # the phase the engines are in
+        self.clock = time.perf_counter()
+
+    def lap(self, phase:str=None) -> None:
+        # the time since the last lap is spent in phase, and the next
+        # phase begins
+        now = time.perf_counter()
+        self.times[self.phase] += now - self.clock
+        self.clock = now
+        if phase is not None:
+            self.phase = phase
+
+    def advanced(self, slots:t.Optional[tuple], threads:list) -> None:
+        # a thread with slots walked a closure into threads, None is a
+        # new thread at the start state
+        self.closures += 1
+        self.threads += len(threads) + (slots is None)
+        for th in threads:
+            if th.slots is not slots:
+                self.copies += 1
+
+    def add(self, other:SearchStats) -> None:
+        self.searches += other.searches
+        self.positions += other.positions
+        self.threads += other.threads
+        self.closures += other.closures
+        self.peakThreads = max(self.peakThreads, other.peakThreads)
+        self.copies += other.copies
+        for phase in SearchStats.PHASES:
+            self.times[phase] += other.times[phase]
+
+    def asdict(self) -> dict:
+        return {
+            'pattern': self.pattern,
+            'searches': self.searches,
+            'positions': self.positions,
+            'threads': self.threads,
+            'closures': self.closures,
+            'peakThreads': self.peakThreads,
+            'copies': self.copies,
+            'times': dict(self.times),
+        }
+
+
+class Profile(object):
+    """ Profile is a hook which adds up the stats of the searches of each
+    pattern it's set on:
+
+        profile = re2.Profile()
+        re2.compile(pattern).setHook(profile)
+        ...
+        profile.report() # the totals, the slowest pattern first
+    """
+    def __init__(self):
+        self.patterns = {} # pattern -> SearchStats
+        self.lock = threading.Lock()
+
+    def __call__(self, stats:SearchStats) -> None:
+        with self.lock:
+            total = self.patterns.get(stats.pattern)
+            if total is None:
+                total = self.patterns[stats.pattern] = \
+                    SearchStats(stats.pattern)
+                total.searches = 0
+            total.add(stats)
+
+    def report(self) -> list[dict]:
+        with self.lock:
+            totals = [s.asdict() for s in self.patterns.values()]
+        return sorted(totals, key=lambda s: -sum(s['times'].values()))
+
+    def clear(self) -> None:
+        with self.lock:
+            self.patterns = {}
 
-            if arc.type == NFAArc.LGROUP:
-                th = self.copy(arc.target)
-                # only record the first occurrence
-                if not th.groups.get(arc.value):
-                    th.groups = copy.deepcopy(self.groups)
-                    th.groups[arc.value] = [self.pos, None]
-                th._advance(threads, visited)
-
-            elif arc.type == NFAArc.RGROUP:
-                assert(self.groups[arc.value])
-                th = self.copy(arc.target)
-                if not th.groups[arc.value][1]:
-                    th.groups = copy.deepcopy(self.groups)
-                    th.groups[arc.value][1] = self.pos
-                th._advance(threads, visited)
-
-            elif arc.type == NFAArc.ANCHOR:
-                if arc.value == NFAAnchor.START and self.pos == 0:
-                    th = self.copy(arc.target)
-                    th._advance(threads, visited)
-                elif arc.value == NFAAnchor.END and self.pos == len(self.text):
-                    th = self.copy(arc.target)
-                    th._advance(threads, visited)
-
-            elif arc.type == NFAArc.EPSILON:
-                th = self.copy(arc.target)
-                th._advance(threads, visited)
-        return
-
-    def copy(self, state, pos=None) -> Thread:
-        th = Thread(self.id, state, self.text, self.pos, self.groups)
-        if pos:
-            th.pos = pos
-        return th
-
-    def advance(self) -> list[NFAState]:
-        newThreads = []
-        visited = set()
-        self._advance(newThreads, visited)
-        return newThreads
-    
 
 class RegExp(object):
     """ A simple regular expression using NFA for matching
@@ -559,15 +2081,35 @@ class RegExp(object):
     usage:
         re = re2.RegExp(pattern)
         g = re.search(text)
+        m = re.exec(text)
         ...
+
+    or use the module functions, which cache the compiled patterns:
+        m = re2.search(pattern, text)
     """
+    # the format of dumps, bump the version when Program changes
+    MAGIC = b're2p'
+    VERSION = 2
+
+    MAX_REPEAT = 65535
+    MAX_EXPANSION = 128 # the states a repeat may copy, else it's counted
+    # the repeats of a fragment matching the empty string can't be counted,
+    # they're copied up to the limit of {n} before the counters came in
+    MAX_NULLABLE_REPEAT = 99
+    BACKTRACK_BITS = 256 * 1024 # the (state, position) bits to backtrack
+    MAX_FALLBACKS = 8 # the searches the DFAs give up before they're dropped
+    # the chunks searchMany searches in process before it starts a pool
+    PARALLEL_CHUNKS = 8
+
     def __init__(self, pattern:str, debug:bool=False):
         self.pat = pattern
         self.debug = debug
+        self.inrange = False # for hyphen
+        self.ranges = {}     # the classes of the pattern
         self.tokenizer = Tokenizer(self.pat, self)
         self.nfa = NFA()
         self.compiled = False
-        self.inrange = False # for hyphen
+        self.hook = None
 
     def getToken(self):
         # getToken get the current token but not consume it
@@ -579,7 +2121,7 @@ class RegExp(object):
         return self.tokenizer.next()
     
     def getRepeat(self) -> tuple[int, int]:
-        # currently the hi value is not allowed to be greater than 100.
+        # the values are not allowed to be greater than MAX_REPEAT.
 
         token = self.nextToken() # consume '{'
         if token.type != Token.CHAR or token.value < 48 or token.value > 57:
@@ -591,7 +2133,7 @@ class RegExp(object):
             while True:
                 v *= 10
                 v += token.value - 48
-                if v >= 100:
+                if v > RegExp.MAX_REPEAT:
                     raise Exception(f'too much repeat')
                 token = regexp.nextToken()
                 if token.type != Token.CHAR:
@@ -648,9 +2190,24 @@ class RegExp(object):
             return self.nfa.plus(a, z)
         elif (lo, hi, greedy) == (1, None, False):
             return self.nfa.plus2(a, z)
+        elif lo == 0 and hi is not None:
+            # {0,n} is ({1,n})? or ({1,n})??
+            a, z = self.genRepeat(a, z, 1, hi, greedy)
+            return self.nfa.quest(a, z) if greedy else self.nfa.quest2(a, z)
         else:
             lst = self.nfa.serialize(a)
             repeatNum = hi-1 if hi is not None else lo-1
+            if len(lst) * repeatNum > RegExp.MAX_EXPANSION:
+                if not self.nfa.nullable(a, z):
+                    # too many copies, count the repeats instead
+                    for s in lst:
+                        s.index = None
+                    return self.nfa.counted(a, z, lo, hi, greedy)
+                # the repeats of a fragment matching the empty string are
+                # told apart by the copies only, don't copy without bound
+                if repeatNum + 1 > RegExp.MAX_NULLABLE_REPEAT:
+                    raise Exception(f'too much repeat of a fragment '
+                                    f'matching the empty string')
             repeats = [(a, z)] + \
                 [self.nfa.copyFragment(lst, z) for i in range(repeatNum)]
 
@@ -737,29 +2294,28 @@ class RegExp(object):
         # e.g [a-zA-Z0-9_]
         self.inrange = True
         self.nextToken() # consume '['
-        r = Range()
+        ranges = []
+        negate = False
 
         token = self.getToken()
         if token.type == Token.CARET:
-            r.negate = True
+            negate = True
             self.nextToken()
 
-        # if hyphen happens at the begin of the range
-        # tolerates it and take it as an character
-        token = self.getToken()
-        if token.type == Token.HYPHEN:
-            token.type = Token.CHAR
-            token.value = 45 # '-'
-
         while True:
+            # if hyphen happens at the begin of the range or after
+            # a range, tolerates it and take it as an character
             token = self.getToken()
+            if token.type == Token.HYPHEN:
+                token.type = Token.CHAR
+                token.value = 45 # '-'
             if token.type != Token.CHAR:
                 raise Exception(f'Unexpected token {token}')
 
             self.nextToken()
             token2 = self.getToken()
             if token2.type == Token.CHAR:
-                r.ranges.append((token.value, token.value))
+                ranges.append((token.value, token.value))
                 continue
             elif token2.type == Token.HYPHEN:
                 self.nextToken()
@@ -769,19 +2325,31 @@ class RegExp(object):
                         # FIXME: not consider it as an error
                         # just flip the values of the 2 tokens
                         token.value, token2.value = token2.value, token.value
-                    r.ranges.append((token.value, token2.value))
+                    ranges.append((token.value, token2.value))
+                    # consume the end of the range
+                    self.nextToken()
+                    if self.getToken().type == Token.RBRACK:
+                        break
                     continue
                 elif token2.type == Token.RBRACK:
                     # if hyphen happens at the end of the range
                     # tolerates it and take it as an character
-                    r.ranges.append((45, 45)) # '-' character
+                    ranges.append((token.value, token.value))
+                    ranges.append((45, 45)) # '-' character
                     break
             elif token2.type == Token.RBRACK:
-                r.ranges.append((token.value, token.value))
+                ranges.append((token.value, token.value))
                 break
 
         self.inrange = False
-        return r
+        return self.newRange(ranges, negate)
+
+    def newRange(self, ranges:list[tuple], negate:bool=False) -> Range:
+        """ newRange returns the class of the ranges, the identical ones
+        in the pattern are the same object.
+        """
+        r = Range(ranges, negate)
+        return self.ranges.setdefault(tuple(r.ranges), r)
 
     def concat(self) -> tuple[NFAState, NFAState]:
         aa = None
@@ -815,7 +2383,7 @@ class RegExp(object):
             elif token.type == Token.DOT:
                 a = self.nfa.newState()
                 z = self.nfa.newState()
-                a.appendArc(z, Range([(0, sys.maxunicode)]), NFAArc.CLASS)
+                a.appendArc(z, self.newRange([(0, sys.maxunicode)]), NFAArc.CLASS)
 
             elif token.type == Token.LBRACK:
                 r = self.getRange()
@@ -842,17 +2410,17 @@ class RegExp(object):
                 elif token.value == 'B':
                     a.appendArc(z, NFAAnchor.NWBOUND, NFAArc.ANCHOR)
                 elif token.value == 'd':
-                    a.appendArc(z, Range([(48, 57)]), NFAArc.CLASS)
+                    a.appendArc(z, self.newRange([(48, 57)]), NFAArc.CLASS)
                 elif token.value == 'D':
-                    a.appendArc(z, Range([(48, 57)], True), NFAArc.CLASS)
+                    a.appendArc(z, self.newRange([(48, 57)], True), NFAArc.CLASS)
                 elif token.value == 'w':
-                    a.appendArc(z, Range([(65, 90),(97, 122),(95, 95)]), NFAArc.CLASS)
+                    a.appendArc(z, self.newRange([(65, 90),(97, 122),(95, 95)]), NFAArc.CLASS)
                 elif token.value == 'W':
-                    a.appendArc(z, Range([(65, 90),(97, 122),(95, 95)], True), NFAArc.CLASS)
+                    a.appendArc(z, self.newRange([(65, 90),(97, 122),(95, 95)], True), NFAArc.CLASS)
                 elif token.value == 's':
-                    a.appendArc(z, Range([(9, 13),(32, 32)]), NFAArc.CLASS)
+                    a.appendArc(z, self.newRange([(9, 13),(32, 32)]), NFAArc.CLASS)
                 elif token.value == 'S':
-                    a.appendArc(z, Range([(9, 13),(32, 32)], True), NFAArc.CLASS)
+                    a.appendArc(z, self.newRange([(9, 13),(32, 32)], True), NFAArc.CLASS)
                 else:
                     # currently not support other type of character-class
                     pass
@@ -877,7 +2445,7 @@ class RegExp(object):
                 zz.appendState(a)
                 zz = z
 
-        if zz == aa:
+        if aa is None:
             # Null String!
             return None, None
         return aa, zz
@@ -930,32 +2498,573 @@ class RegExp(object):
         end.accept = True
         self.nfa.start = start
         self.nfa.end = end
-        self.nodes = self.nfa.serialize(self.nfa.start, self.debug)
+        self.nfa.start = self.nfa.optimize(start, end)
+        nodes = self.nfa.serialize(self.nfa.start, self.debug)
+        if end.index is None:
+            # the pattern can never match, keep the accept state anyway
+            end.index = len(nodes)
+            nodes.append(end)
+        self.setProgram(Program.lower(nodes, self.nfa.end, self.nfa.groups,
+                                      self.nfa.repeats))
+        # the graph is not needed any more once it's lowered
+        self.nfa.start = self.nfa.end = None
+
+    def setProgram(self, prog:Program) -> None:
+        self.prog = prog
+        self.dfa = LazyDFA(prog)
+        self.rdfa = None # built by reverseDFA when it's first needed
+        self.plan = Plan(prog)
+        self.fallbacks = 0
         self.compiled = True
 
-    def addThread(self, text:str, pos:int, gen):
-        start = self.nfa.start
-        th = Thread(next(gen), start, text, pos, groups=None)
-        threads = th.advance()
+    def reverseDFA(self) -> ReverseDFA:
+        """ reverseDFA returns the reverse automaton, it's built the first
+        time the start of a match is searched backwards, the anchored
+        plans and match never do.
+        """
+        if self.rdfa is None:
+            self.rdfa = ReverseDFA(self.prog)
+        return self.rdfa
+
+    def explain(self) -> dict:
+        """ explain reports how the pattern is matched: the engines of
+        the plan, what they are chosen from, the literals used to skip
+        the text, and the estimated cost.
+        """
+        if self.compiled == False:
+            self.compile()
+
+        prog = self.prog
+        def text(literal):
+            return ''.join(map(chr, literal))
+        return {
+            'pattern': self.pat,
+            'scan': self.plan.scan,
+            'capture': self.plan.capture,
+            'anchored': self.plan.anchored,
+            'onepass': prog.onepass,
+            'states': len(prog),
+            'groups': prog.groups,
+            'counters': len(prog.repeats),
+            'prefix': text(prog.prefix),
+            'firstChars': None if prog.firstChars is None else
+                          text(sorted(prog.firstChars)),
+            'required': [text(literal) for literal in prog.required],
+            'backtrack': self.BACKTRACK_BITS // len(prog)
+                         if len(prog.repeats) == 0 else 0,
+            'cost': self.plan.cost(prog),
+            'cache': {
+                'forward': self.dfa.info()._asdict(),
+                'reverse': (self.rdfa.info() if self.rdfa is not None else
+                            DFACacheInfo(0, 0, ReverseDFA.MAX_MEMORY, 0)
+                            )._asdict(),
+                'fallbacks': self.fallbacks,
+            },
+        }
+
+    def __reduce__(self):
+        # pickled as the compiled program, the pattern is not parsed again
+        return RegExp.loads, (self.dumps(),)
+
+    def dumps(self) -> bytes:
+        """ dumps returns the compiled pattern in a versioned marshal
+        format, which loads reads back without parsing the pattern.
+        """
+        if self.compiled == False:
+            self.compile()
+        return marshal.dumps((RegExp.MAGIC, RegExp.VERSION, 
+                              self.pat, self.prog.pack()))
+
+    @staticmethod
+    def loads(data:bytes) -> RegExp:
+        try:
+            magic, version, pattern, packed = marshal.loads(data)
+        except (EOFError, ValueError, TypeError):
+            raise ValueError('Invalid compiled pattern')
+        if magic != RegExp.MAGIC or version != RegExp.VERSION:
+            raise ValueError(f'Unsupported compiled pattern version')
+
+        regexp = RegExp.__new__(RegExp)
+        regexp.pat = pattern
+        regexp.debug = False
+        regexp.tokenizer = None
+        regexp.nfa = None
+        regexp.inrange = False
+        regexp.hook = None
+        regexp.setProgram(Program.unpack(packed))
+        return regexp
+
+    def setHook(self, hook:t.Optional[t.Callable[[SearchStats], None]]) \
+            -> None:
+        """ setHook calls hook with the SearchStats of each search after
+        it's done, e.g. a Profile. None turns it off, the searches count
+        nothing then.
+        """
+        self.hook = hook
+
+    def renew(self) -> None:
+        """ renew starts over with a fresh copy of a program with counters
+        once its configurations take more than the memory of its DFA. the
+        DFAs are built again as they number the configurations too.
+        """
+        prog = self.prog
+        if prog.configMemory <= self.dfa.maxMemory:
+            return
+        self.prog = prog.renew()
+        self.dfa = LazyDFA(self.prog, self.dfa.maxStates, 
+                           self.dfa.maxMemory, self.dfa.budget)
+        if self.rdfa is not None:
+            self.rdfa = ReverseDFA(self.prog, self.rdfa.maxStates,
+                                   self.rdfa.maxMemory, self.rdfa.budget)
+
+    def addThread(self, text:str, pos:int, gen, anchorEnd:bool=False,
+                  notEmpty:int=-1, stop:int=None, prog:Program=None):
+        prog = prog or self.prog
+        slots = (pos,) + (None,) * (2 * prog.groups + 1)
+        th = Thread(next(gen), prog.start, text, pos, slots)
+        threads = th.advance(prog, anchorEnd, notEmpty, stop)
         return threads
 
     def search(self, text, pos=0) -> dict:
+        """ search returns {group: [start, end]} of the leftmost match,
+        or None if there is no match.
+        """
+        m = self.exec(text, pos)
+        return m.spans() if m is not None else None
+
+    def exec(self, text, pos=0, endpos=None) -> t.Optional[Match]:
+        """ exec returns the Match object of the leftmost match, or None
+        if there is no match. as python's re, the text is taken as if it
+        ended at endpos.
+        """
+        return self.run(text, pos, endpos=endpos)
+
+    def match(self, text, pos=0) -> t.Optional[Match]:
+        """ match returns the Match object if the text matches at pos. """
+        return self.run(text, pos, anchorStart=True)
+
+    def fullmatch(self, text, pos=0) -> t.Optional[Match]:
+        """ fullmatch returns the Match object if the whole text after
+        pos matches.
+        """
+        return self.run(text, pos, anchorStart=True, anchorEnd=True)
+
+    def searchMany(self, records:t.Iterable, workers:int=None,
+                   chunksize:int=256) -> t.Iterator[t.Optional[Match]]:
+        """ searchMany yields the Match object of the leftmost match of
+        each record, or None, in the order of the records. with workers
+        greater than 1, the records are searched by a pool of workers in
+        chunks, each worker gets the compiled program once. by default,
+        they're searched in process unless there are more than
+        PARALLEL_CHUNKS chunks, as starting a pool costs more than
+        searching a few records. only a few chunks are in flight, so the
+        records may come from a generator of any length.
+        """
+        if self.compiled == False:
+            self.compile()
+
+        records = iter(records)
+        chunks = iter(lambda: list(islice(records, chunksize)), [])
+        if workers is None:
+            first = list(islice(chunks, self.PARALLEL_CHUNKS + 1))
+            if len(first) > self.PARALLEL_CHUNKS:
+                workers = os.cpu_count() or 1
+            chunks = chain(first, chunks)
+        if workers is None or workers <= 1:
+            for chunk in chunks:
+                yield from map(self.exec, chunk)
+            return
+
+        pending = deque()
+        with ProcessPoolExecutor(workers, initializer=initSearchWorker,
+                                 initargs=(self,)) as executor:
+            for chunk in chunks:
+                pending.append((chunk, executor.submit(searchChunk, chunk)))
+                if len(pending) < 2 * workers:
+                    continue
+                chunk, future = pending.popleft()
+                yield from self.matches(chunk, future.result())
+            while pending:
+                chunk, future = pending.popleft()
+                yield from self.matches(chunk, future.result())
+
+    def matches(self, records:list, results:list) -> t.Iterator[Match]:
+        # turn the slots from a worker back into Match objects
+        for record, slots in zip(records, results):
+            yield Match(self, record, 0, slots) if slots is not None else None
+
+    def stream(self) -> Stream:
+        """ stream returns a Stream which finds the matches in a text
+        given in chunks.
+        """
+        if self.compiled == False:
+            self.compile()
+        return Stream(self)
+
+    def finditer(self, text, pos=0) -> t.Iterator[Match]:
+        """ finditer yields the Match objects of the non-overlapping
+        matches from left to right. the text is decoded once, and each
+        search goes on from where the last match ends. as python's re, an
+        empty match is allowed right after a non-empty match, but not at
+        the end of another empty match.
+        """
+        if self.compiled == False:
+            self.compile()
+
+        hook = self.hook
+        stats = SearchStats(self.pat) if hook is not None else None
+        if not LiteralScanner.prefilter(text, self.prog, pos):
+            if stats is not None:
+                stats.lap()
+                hook(stats)
+            return
+
+        codes = readText(text)
+        scanner = LiteralScanner.create(text, self.prog)
+        notEmpty = -1
+        while pos <= len(codes):
+            self.renew()
+            if stats is not None:
+                stats.lap('scan')
+                slots = self.locate(codes, pos, scanner, notEmpty, stats)
+                stats.lap()
+                hook(stats)
+            else:
+                slots = self.locate(codes, pos, scanner, notEmpty)
+            if slots is None:
+                return
+            yield Match(self, text, pos, slots)
+            pos = slots[1]
+            notEmpty = pos if slots[0] == pos else -1
+            if stats is not None:
+                # each match is a search of its own
+                stats = SearchStats(self.pat)
+
+    def findall(self, text, pos=0) -> list:
+        """ findall returns the matches as python's re does: the strings
+        matched if there is no group, else the first group, or tuples of
+        all the groups if there are more than one.
+        """
+        result = []
+        for m in self.finditer(text, pos):
+            if self.prog.groups == 0:
+                result.append(m.group())
+            elif self.prog.groups == 1:
+                result.append(m.groups('')[0])
+            else:
+                result.append(m.groups(''))
+        return result
+
+    def run(self, text, pos=0, anchorStart:bool=False, 
+            anchorEnd:bool=False, endpos=None) -> t.Optional[Match]:
+        """ run the NFA simulation, anchorStart only tries a match at 
+        pos, anchorEnd only accepts a match ending at the end of text.
+        """
         if self.compiled == False:
             self.compile()
 
+        self.renew()
+        stats = SearchStats(self.pat) if self.hook is not None else None
+        if not LiteralScanner.prefilter(text, self.prog, pos, endpos):
+            if stats is not None:
+                stats.lap()
+                self.hook(stats)
+            return None
+
+        codes = readText(text)[:endpos]
+        scanner = LiteralScanner.create(text, self.prog, len(codes))
+        if stats is not None:
+            stats.lap('capture' if anchorStart else 'scan')
+        if anchorStart and self.plan.capture == 'onepass':
+            slots = self.onePass(codes, pos, anchorEnd, stats=stats)
+        elif anchorStart or anchorEnd:
+            slots = self.runNFA(codes, pos, scanner, anchorStart, anchorEnd,
+                                stats=stats)
+        else:
+            slots = self.locate(codes, pos, scanner, stats=stats)
+        if stats is not None:
+            stats.lap()
+            self.hook(stats)
+        if slots is None:
+            return None
+        return Match(self, text, pos, slots)
+
+    def locate(self, text:memoryview, pos:int, scanner:LiteralScanner,
+               notEmpty:int=-1, stats:SearchStats=None) -> t.Optional[tuple]:
+        """ locate returns the slots of the leftmost match in the decoded
+        text in three steps: the lazy DFA finds where the match ends, the
+        reverse DFA finds where it starts, and only then the threads run
+        from the start to the end of the match to fill in the groups.
+        the anchors still see the whole text. an empty match at notEmpty
+        is not accepted.
+        """
+        if notEmpty == pos:
+            # a match at pos must not be empty, the DFA can't tell
+            slots = self.runNFA(text, pos, None, anchorStart=True,
+                                notEmpty=notEmpty, stats=stats)
+            if slots is not None or pos == len(text):
+                return slots
+            pos += 1
+
+        plan = self.plan
+        if plan.scan == 'anchored':
+            # ^ only holds at 0
+            if pos > 0:
+                return None
+            if plan.capture == 'onepass':
+                return self.onePass(text, pos, stats=stats)
+            return self.runNFA(text, pos, None, anchorStart=True, 
+                               stats=stats)
+        if plan.scan == 'literal' and scanner is not None:
+            start = scanner.next(pos)
+            if stats is not None:
+                stats.positions += (start if start >= 0 else len(text)) - pos
+            return (start, start + len(self.prog.prefix)) \
+                if start >= 0 else None
+        if plan.capture != 'nfa' and self.canBacktrack(pos, len(text)):
+            # the text is short, the DFAs would cost more than they save
+            return self.backtrack(text, pos, scanner, stats=stats)
+        if plan.scan == 'nfa':
+            return self.simulate(text, pos, scanner, stats=stats)
+
+        try:
+            end = self.dfa.searchEnd(text, pos, scanner, stats)
+            if end is None:
+                return None
+            start = self.reverseDFA().searchStart(text, pos, end, stats)
+        except DFACacheFull:
+            # too many states for the DFA, use the NFA simulation
+            self.fallback()
+            return self.simulate(text, pos, scanner, stats=stats)
+
+        if self.prog.groups == 0:
+            return (start, end)
+        if stats is not None:
+            stats.lap('capture')
+        if plan.capture == 'onepass':
+            return self.onePass(text, start, stop=end, stats=stats)
+        return self.runNFA(text, start, None, anchorStart=True, stop=end,
+                           stats=stats)
+
+    def fallback(self) -> None:
+        """ fallback is called when the DFAs give up a search because
+        their cache is flushed too often. once they've given up too many
+        searches, the threads scan the text from then on and the memory
+        of the DFAs is given back.
+        """
+        self.fallbacks += 1
+        if self.fallbacks >= self.MAX_FALLBACKS and self.plan.scan == 'dfa':
+            self.plan.scan = 'nfa'
+            self.dfa.flush()
+            if self.rdfa is not None:
+                self.rdfa.flush()
+
+    def runNFA(self, text:memoryview, pos:int, scanner:LiteralScanner,
+               anchorStart:bool=False, anchorEnd:bool=False,
+               notEmpty:int=-1, stop:int=None,
+               stats:SearchStats=None) -> t.Optional[tuple]:
+        """ runNFA backtracks if the bitmap fits, else it runs the 
+        threads, both give the same slots.
+        """
+        if self.plan.capture != 'nfa' and \
+           self.canBacktrack(pos, len(text) if stop is None else stop):
+            return self.backtrack(text, pos, scanner, anchorStart, 
+                                  anchorEnd, notEmpty, stop, stats)
+        return self.simulate(text, pos, scanner, anchorStart, anchorEnd,
+                             notEmpty, stop, stats)
+
+    def canBacktrack(self, pos:int, stop:int) -> bool:
+        # the counters make too many configurations for the bitmap
+        return len(self.prog.repeats) == 0 and pos <= stop and \
+            len(self.prog) * (stop - pos + 1) <= self.BACKTRACK_BITS
+
+    def backtrack(self, text:memoryview, pos:int, scanner:LiteralScanner,
+                  anchorStart:bool=False, anchorEnd:bool=False,
+                  notEmpty:int=-1, stop:int=None,
+                  stats:SearchStats=None) -> t.Optional[tuple]:
+        """ backtrack returns the same slots as simulate, it tries the
+        closures depth first in priority order from each position. a
+        (state, position) pair which has been tried once can only fail
+        again, it's marked in a bitmap, so no pair is tried twice and
+        the time is still linear.
+        """
+        prog = self.prog
+        size = len(text)
+        stop = size if stop is None else stop
+        width = stop - pos + 1
+        visited = bytearray((len(prog) * width + 7) >> 3)
+        closures = prog.closures
+        empty = (None,) * (2 * prog.groups + 1)
+        start = pos
+
+        while start <= stop:
+            if scanner is not None and not anchorStart:
+                start = scanner.next(start)
+                if start < 0 or start > stop:
+                    break
+            # the accept entries are (None, slots), they're taken only
+            # after all the arcs before them fail
+            stack = [(prog.start, start, (start,) + empty)]
+            furthest = start
+            while stack:
+                state, p, slots = stack.pop()
+                if state is None:
+                    break
+                bit = state * width + p - pos
+                if visited[bit >> 3] & (1 << (bit & 7)):
+                    continue
+                visited[bit >> 3] |= 1 << (bit & 7)
+                if stats is not None:
+                    stats.closures += 1
+                    furthest = max(furthest, p)
+
+                c = text[p] if p < size else None
+                entries = []
+                for ops, type_, value, target in \
+                        closures[textContext(p, size)][state]:
+                    if type_ == NFAArc.EPSILON:
+                        if anchorEnd and p != size or \
+                           p == notEmpty and slots[0] == p:
+                            continue
+                        matched = Thread.capture(slots, ops, p)
+                        entries.append((None, 0, 
+                                        (matched[0], p) + matched[2:]))
+                        break
+
+                    if p >= stop:
+                        continue
+                    if type_ == NFAArc.CHAR:
+                        if value != c:
+                            continue
+                    elif not value.match(c):
+                        continue
+
+                    matched = Thread.capture(slots, ops, p)
+                    if target == prog.accept:
+                        if anchorEnd and p + 1 != size:
+                            continue
+                        entries.append((None, 0, 
+                                        (matched[0], p + 1) + matched[2:]))
+                        break
+                    entries.append((target, p + 1, matched))
+                stack += reversed(entries)
+                if stats is not None:
+                    stats.threads += len(entries)
+                    stats.copies += sum(e[2] is not slots for e in entries)
+                    stats.peakThreads = max(stats.peakThreads, len(stack))
+
+            if stats is not None:
+                stats.positions += furthest - start + 1
+            if state is None:
+                return slots
+            if anchorStart:
+                break
+            start += 1
+        return None
+
+    def onePass(self, text:memoryview, pos:int, anchorEnd:bool=False,
+                stop:int=None, stats:SearchStats=None) -> t.Optional[tuple]:
+        """ onePass returns the slots of the match at pos of a one-pass
+        program. there is no thread list: the only arc which can go on
+        is taken and the groups are set in place, the accept state met
+        on the way is kept in case the arcs taken after it fail.
+        """
+        prog = self.prog
+        size = len(text)
+        stop = size if stop is None else stop
+        slots = [pos] + [None] * (2 * prog.groups + 1)
+        state = prog.start
+        matched = None
+        begin = pos
+
+        while pos <= stop:
+            closure = prog.closures[textContext(pos, size)][state]
+            c = text[pos] if pos < size else None
+            next = None
+
+            for ops, type_, value, target in closure:
+                if type_ == NFAArc.EPSILON:
+                    if anchorEnd and pos != size:
+                        continue
+                    matched = RegExp.capture(list(slots), ops, pos)
+                    matched[1] = pos
+                    break
+
+                if type_ == NFAArc.CHAR:
+                    if value != c:
+                        continue
+                elif not value.match(c):
+                    continue
+
+                if target == prog.accept:
+                    if anchorEnd and pos + 1 != size:
+                        continue
+                    matched = RegExp.capture(list(slots), ops, pos)
+                    matched[1] = pos + 1
+                    break
+                # the arcs are one-pass, no other arc takes c
+                next = (ops, target)
+
+            if next is None:
+                break
+            RegExp.capture(slots, next[0], pos)
+            state = next[1]
+            pos += 1
+
+        if stats is not None:
+            # one thread walks one closure per position, the slots are
+            # only copied when the accept state is met
+            walked = min(pos, stop) - begin + 1
+            stats.positions += walked
+            stats.closures += walked
+            stats.threads += 1
+            stats.peakThreads = max(stats.peakThreads, 1)
+            stats.copies += matched is not None
+        return tuple(matched) if matched is not None else None
+
+    @staticmethod
+    def capture(slots:list, ops:tuple, pos:int) -> list:
+        # the same as Thread.capture, in place
+        for type_, group in ops:
+            if type_ == NFAArc.LGROUP:
+                if slots[2 * group] is None:
+                    slots[2 * group] = pos
+            elif not slots[2 * group + 1]:
+                slots[2 * group + 1] = pos
+        return slots
+
+    def simulate(self, text:memoryview, pos:int, scanner:LiteralScanner,
+                 anchorStart:bool=False, anchorEnd:bool=False,
+                 notEmpty:int=-1, stop:int=None,
+                 stats:SearchStats=None) -> t.Optional[tuple]:
+        """ simulate returns the slots of the leftmost match in the 
+        decoded text, an empty match at notEmpty is not accepted. the
+        match ends at stop at the latest, if it's known to end there.
+        """
+        prog = self.prog # kept if the program is renewed meanwhile
+        start = pos
         threads = OrderedDict()
         gen = count()
         matchThread = None
         matched = False
+        stop = len(text) if stop is None else stop
 
-        while pos <= len(text):
+        while pos <= stop:
+            if len(threads) == 0 and not matchThread and scanner:
+                # skip the positions where no match can start
+                pos = scanner.next(pos)
+                if pos < 0 or anchorStart and pos != start:
+                    break
             newThreads = OrderedDict() # result (state, thread)
             matched = False
 
             for _, thread in threads.items():
-                threads = thread.advance()
+                threads = thread.advance(prog, anchorEnd, notEmpty,
+                                         stop)
+                if stats is not None:
+                    stats.advanced(thread.slots, threads)
                 for th in threads:
-                    if th.state.accept:
+                    if th.state == prog.accept:
                         matchThread = th
                         # all the thread in threads have the same gid
                         # we don't need to advance any more
@@ -971,10 +3080,13 @@ class RegExp(object):
                     break
             
             # try to add new threads at the start state
-            if not matchThread:
-                threads = self.addThread(text, pos, gen)
+            if not matchThread and (pos == start or not anchorStart):
+                threads = self.addThread(text, pos, gen, anchorEnd, 
+                                         notEmpty, stop, prog)
+                if stats is not None:
+                    stats.advanced(None, threads)
                 for th in threads:
-                    if th.state.accept:
+                    if th.state == prog.accept:
                         matchThread = th
                         # all the thread in threads have the same gid
                         # we don't need to advance any more
@@ -982,10 +3094,647 @@ class RegExp(object):
                     if not newThreads.get(th.state):
                         newThreads[th.state] = th
             
-            if len(newThreads) == 0 and matchThread:
+            if stats is not None:
+                stats.positions += 1
+                stats.peakThreads = max(stats.peakThreads, len(newThreads))
+            if len(newThreads) == 0 and (matchThread or anchorStart):
                 break
 
             threads = newThreads
             pos += 1
 
-        return matchThread.groups if matchThread is not None else None
+        if matchThread is None:
+            return None
+        return matchThread.slots
+
+    def prefilter(self, text, pos=0) -> bool:
+        """ prefilter returns False if the text after pos can not match,
+        because it lacks a literal every match contains.
+        """
+        if self.compiled == False:
+            self.compile()
+        return LiteralScanner.prefilter(text, self.prog, pos)
+
+    def searchSpan(self, text, pos=0, 
+                   endpos=None) -> t.Optional[tuple[int, int]]:
+        """ searchSpan returns the span of the match only, it runs the
+        lazy DFA forwards to find where the match ends and backwards to
+        find where it starts, no thread or group is created. the threads
+        are run instead if the plan doesn't use the DFAs.
+        """
+        if self.compiled == False:
+            self.compile()
+
+        self.renew()
+        stats = SearchStats(self.pat) if self.hook is not None else None
+        if not LiteralScanner.prefilter(text, self.prog, pos, endpos):
+            if stats is not None:
+                stats.lap()
+                self.hook(stats)
+            return None
+
+        codes = readText(text)[:endpos]
+        scanner = LiteralScanner.create(text, self.prog, len(codes))
+        if stats is not None:
+            stats.lap('scan')
+        span = slots = None
+        if self.plan.scan == 'nfa':
+            # the DFAs are not used for this pattern
+            slots = self.simulate(codes, pos, scanner, stats=stats)
+        else:
+            try:
+                end = self.dfa.searchEnd(codes, pos, scanner, stats)
+                if end is not None:
+                    span = self.reverseDFA().searchStart(codes, pos, end, 
+                                                         stats), end
+            except DFACacheFull:
+                # too many states for the DFA, use the NFA simulation
+                self.fallback()
+                slots = self.simulate(codes, pos, scanner, stats=stats)
+        if slots is not None:
+            span = slots[:2]
+        if stats is not None:
+            stats.lap()
+            self.hook(stats)
+        return span
+
+
+class Stream(object):
+    """ Stream finds the matches of a pattern in a text which comes in
+    chunks, the same ones finditer finds in the whole text. the threads
+    of the NFA simulation are kept from one chunk to the next and all
+    the positions are absolute. only the text from the start of the
+    earliest pending match on is kept, to read the groups from and to
+    scan again after a match.
+
+    usage:
+        stream = re2.compile(pattern).stream()
+        for chunk in chunks:
+            for m in stream.feed(chunk):
+                ...
+        for m in stream.flush():
+            ...
+    """
+    def __init__(self, regexp:RegExp):
+        self.re = regexp
+        self.prog = regexp.prog
+        # the code points a match can start with, to skip ahead
+        if len(self.prog.prefix) > 0:
+            self.firstChars = (self.prog.prefix[0],)
+        elif self.prog.firstChars is not None:
+            self.firstChars = tuple(sorted(self.prog.firstChars))
+        else:
+            self.firstChars = None
+        self.reset()
+
+    def reset(self) -> None:
+        self.buffer = None  # the text kept, buffer[0] is at base
+        self.base = 0
+        self.pos = 0        # the position of the next character
+        self.threads = []   # (state, slots) in priority order
+        self.matched = None # the slots of the best match so far
+        self.notEmpty = -1
+
+    def feed(self, chunk) -> list[Match]:
+        """ feed scans the next chunk of the text, it returns the matches
+        which can not change any more whatever comes next.
+        """
+        if not isinstance(chunk, str):
+            chunk = bytes(chunk)
+        if self.buffer is None:
+            self.buffer = chunk
+        else:
+            self.buffer += chunk
+        return self.scan(False)
+
+    def flush(self) -> list[Match]:
+        """ flush ends the text and returns the rest of the matches, the
+        stream can be used for another text after that.
+        """
+        if self.buffer is None:
+            self.buffer = ''
+        matches = self.scan(True)
+        self.reset()
+        return matches
+
+    def skip(self, pos:int) -> int:
+        """ skip returns the first position not before pos where a match
+        may start, or -1 if there is none in the buffer.
+        """
+        found = -1
+        for c in self.firstChars:
+            needle = LiteralScanner.needle(self.buffer, (c,))
+            if needle is None:
+                continue
+            i = self.buffer.find(needle, pos - self.base)
+            if i >= 0 and (found < 0 or i < found):
+                found = i
+        return found + self.base if found >= 0 else -1
+
+    def scan(self, final:bool) -> list[Match]:
+        matches = []
+        codes = readText(self.buffer)
+        size = self.base + len(codes)
+
+        while self.pos < size or final and self.pos == size:
+            pos = self.pos
+            if len(self.threads) == 0 and self.matched is None and \
+               self.firstChars is not None:
+                pos = self.skip(pos)
+                if pos < 0:
+                    # the text end can't match, a match starts with one
+                    self.pos = size + 1 if final else size
+                    break
+
+            ctx = CTX_BEGIN if pos == 0 else CTX_NONE
+            if pos == size:
+                ctx |= CTX_END
+            c = codes[pos - self.base] if pos < size else None
+            self.step(pos, c, ctx)
+            self.pos = pos + 1
+
+            if len(self.threads) == 0 and self.matched is not None:
+                slots = self.matched
+                start, end = slots[0], slots[1]
+                string = self.buffer[start-self.base:end-self.base]
+                matches.append(Match(self.re, string, start, slots, start))
+                # go on from the end of the match as finditer does
+                self.pos = end
+                self.matched = None
+                self.notEmpty = end if start == end else -1
+
+        # drop the text no pending match can use
+        keep = self.pos
+        if self.matched is not None:
+            keep = min(keep, self.matched[0])
+        for _, slots in self.threads:
+            keep = min(keep, slots[0])
+        keep = min(keep, size)
+        self.buffer = self.buffer[keep-self.base:]
+        self.base = keep
+        return matches
+
+    def step(self, pos:int, c:t.Optional[int], ctx:int) -> None:
+        """ step advances the threads over the character at pos as
+        RegExp.simulate does, c is None at the end of the text.
+        """
+        prog = self.prog
+        threads = self.threads
+        if self.matched is None:
+            slots = (pos,) + (None,) * (2 * prog.groups + 1)
+            threads = threads + [(prog.start, slots)]
+
+        out = []
+        seen = set()
+        for state, slots in threads:
+            matched = None
+            for ops, type_, value, target in prog.closures[ctx][state]:
+                if type_ == NFAArc.EPSILON:
+                    if pos == self.notEmpty and slots[0] == pos:
+                        continue
+                    matched = Thread.capture(slots, ops, pos), pos
+                    break
+                if c is None:
+                    continue
+                if type_ == NFAArc.CHAR:
+                    if value != c:
+                        continue
+                elif not value.match(c):
+                    continue
+                if target == prog.accept:
+                    matched = Thread.capture(slots, ops, pos), pos + 1
+                    break
+                if target not in seen:
+                    seen.add(target)
+                    out.append((target, Thread.capture(slots, ops, pos)))
+
+            if matched is not None:
+                # the threads after the matching one are cut
+                slots, end = matched
+                self.matched = (slots[0], end) + slots[2:]
+                break
+        self.threads = out
+
+
+class RegexSet(object):
+    """ RegexSet matches many patterns in one pass over the text, the
+    compiled patterns are joined into one program whose accept states
+    are tagged with the index of their pattern.
+
+    usage:
+        rs = re2.RegexSet([pattern1, pattern2, ...])
+        indexes = rs.matches(text)
+        spans = rs.spans(text)
+    """
+    def __init__(self, patterns:list[t.Union[str, RegExp]]):
+        self.regexps = [compile(p) for p in patterns]
+        self.patterns = [r.pat for r in self.regexps]
+        self.prog = Program.union([r.prog for r in self.regexps])
+        self.dfa = SetDFA(self.prog)
+
+    def __len__(self) -> int:
+        return len(self.regexps)
+
+    def matches(self, text, pos:int=0) -> list[int]:
+        """ matches returns the indexes of the patterns which match the
+        text after pos, in increasing order.
+        """
+        if len(self.regexps) == 0:
+            return []
+
+        codes = readText(text)
+        scanner = LiteralScanner.create(text, self.prog)
+        try:
+            found = self.dfa.searchTags(codes, pos, scanner)
+        except DFACacheFull:
+            # too many states, search the patterns one by one
+            found = [k for k, r in enumerate(self.regexps)
+                     if r.searchSpan(text, pos) is not None]
+        return sorted(found)
+
+    def spans(self, text, pos:int=0) -> dict[int, tuple[int, int]]:
+        """ spans returns {index: (start, end)} of the leftmost match of
+        each pattern which matches the text, only the patterns found by
+        matches are searched again.
+        """
+        result = {}
+        for k in self.matches(text, pos):
+            result[k] = self.regexps[k].searchSpan(text, pos)
+        return result
+
+
+CacheInfo = namedtuple('CacheInfo', ['hits', 'misses', 'maxsize', 'currsize'])
+
+
+class PatternCache(object):
+    """ PatternCache keeps the most recently used compiled patterns,
+    it can be shared by threads. if a directory is set, the compiled
+    patterns are also stored there and read back by later processes.
+    """
+    MAX_SIZE = 512
+
+    def __init__(self, maxsize:int=None, directory:str=None):
+        self.maxsize = self.MAX_SIZE if maxsize is None else maxsize
+        self.directory = directory
+        self.patterns = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, pattern:str) -> RegExp:
+        key = (type(pattern), pattern)
+        with self.lock:
+            regexp = self.patterns.get(key)
+            if regexp is not None:
+                self.patterns.move_to_end(key)
+                self.hits += 1
+                return regexp
+            self.misses += 1
+
+        # compile without holding the lock, it may take a while
+        regexp = self.load(pattern)
+
+        with self.lock:
+            if self.maxsize > 0:
+                regexp = self.patterns.setdefault(key, regexp)
+                self.patterns.move_to_end(key)
+                while len(self.patterns) > self.maxsize:
+                    self.patterns.popitem(last=False)
+        return regexp
+
+    def path(self, pattern:str) -> str:
+        key = repr((RegExp.VERSION, type(pattern).__name__, pattern))
+        digest = hashlib.sha256(key.encode('utf-8', 'surrogatepass'))
+        return os.path.join(self.directory, digest.hexdigest() + '.re2c')
+
+    def load(self, pattern:str) -> RegExp:
+        """ load reads the compiled pattern from the directory, or 
+        compiles and stores it there. the directory is only a cache,
+        errors reading or writing it are ignored.
+        """
+        directory = self.directory
+        if directory is None:
+            regexp = RegExp(pattern)
+            regexp.compile()
+            return regexp
+
+        path = self.path(pattern)
+        try:
+            with open(path, 'rb') as f:
+                regexp = RegExp.loads(f.read())
+            if regexp.pat == pattern:
+                return regexp
+        except (OSError, ValueError):
+            pass
+
+        regexp = RegExp(pattern)
+        regexp.compile()
+        tmp = None
+        try:
+            # write to a temporary file first, others may be reading
+            fd, tmp = tempfile.mkstemp(dir=directory, suffix='.tmp')
+            with os.fdopen(fd, 'wb') as f:
+                f.write(regexp.dumps())
+            os.replace(tmp, path)
+        except OSError:
+            if tmp is not None and os.path.exists(tmp):
+                os.unlink(tmp)
+        return regexp
+
+    def resize(self, maxsize:int) -> None:
+        with self.lock:
+            self.maxsize = maxsize
+            while len(self.patterns) > max(maxsize, 0):
+                self.patterns.popitem(last=False)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.patterns.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self) -> CacheInfo:
+        with self.lock:
+            return CacheInfo(self.hits, self.misses, 
+                             self.maxsize, len(self.patterns))
+
+
+patternCache = PatternCache()
+
+
+def compile(pattern:t.Union[str, RegExp]) -> RegExp:
+    """ compile returns the compiled pattern, from the cache if it has
+    been compiled recently.
+    """
+    if isinstance(pattern, RegExp):
+        return pattern
+    return patternCache.get(pattern)
+
+def search(pattern, text, pos:int=0) -> t.Optional[Match]:
+    return compile(pattern).exec(text, pos)
+
+def match(pattern, text, pos:int=0) -> t.Optional[Match]:
+    return compile(pattern).match(text, pos)
+
+def fullmatch(pattern, text, pos:int=0) -> t.Optional[Match]:
+    return compile(pattern).fullmatch(text, pos)
+
+def searchMany(pattern, records:t.Iterable, workers:int=None,
+               chunksize:int=256) -> t.Iterator[t.Optional[Match]]:
+    return compile(pattern).searchMany(records, workers, chunksize)
+
+def finditer(pattern, text, pos:int=0) -> t.Iterator[Match]:
+    return compile(pattern).finditer(text, pos)
+
+def findall(pattern, text, pos:int=0) -> list:
+    return compile(pattern).findall(text, pos)
+
+def purge() -> None:
+    """ purge clears the cache of compiled patterns. """
+    patternCache.clear()
+
+def setCacheSize(maxsize:int) -> None:
+    patternCache.resize(maxsize)
+
+def cacheInfo() -> CacheInfo:
+    return patternCache.info()
+
+def setDFAMemory(maxMemory:int) -> None:
+    """ setDFAMemory sets the bytes the DFA caches of all the patterns
+    may take together, the caches used the longest time ago are flushed
+    to make room.
+    """
+    dfaBudget.resize(maxMemory)
+
+def dfaCacheInfo() -> DFACacheInfo:
+    return dfaBudget.info()
+
+def setCacheDir(directory:t.Optional[str]) -> None:
+    """ setCacheDir sets the directory compile stores the compiled
+    patterns in, None turns it off.
+    """
+    if directory is not None:
+        os.makedirs(directory, exist_ok=True)
+    patternCache.directory = directory
+
+
+searchWorker = None # the pattern searchChunk uses in a worker process
+
+def initSearchWorker(regexp:RegExp) -> None:
+    global searchWorker
+    searchWorker = regexp
+
+def searchChunk(records:list) -> list[t.Optional[tuple]]:
+    """ searchChunk returns the slots of the match of each record, the
+    Match objects are made by the caller, which has the records.
+    """
+    result = []
+    for record in records:
+        m = searchWorker.exec(record)
+        result.append(m.slots if m is not None else None)
+    return result
+
+
+GREP_SEGMENT = 1 << 24 # bytes of a file a worker scans at a time
+
+def lineStart(buffer, pos:int) -> int:
+    """ lineStart returns where the first line not before pos starts. """
+    if pos <= 0:
+        return 0
+    i = buffer.find(b'\n', pos - 1)
+    return len(buffer) if i < 0 else i + 1
+
+def grepBuffer(regexp:RegExp, buffer, start:int, end:int,
+               options:tuple) -> tuple[list, int, int]:
+    """ grepBuffer returns the lines from start to end which match, as
+    (line number, bytes) with the line numbers counted from start, the
+    number of lines and the number of the matching lines.
+    """
+    lineNumbers, onlyMatching = options
+    anchored = NFAArc.ANCHOR in regexp.prog.types
+    view = memoryview(buffer)
+    lines = []
+    matches = 0
+    lineno = 0
+    counted = start
+    pos = start
+
+    while pos < end:
+        if anchored:
+            # ^ and $ are the start and end of each line
+            ls = pos
+            le = buffer.find(b'\n', pos, end)
+            le = end if le < 0 else le
+            if regexp.searchSpan(view[ls:le]) is None:
+                pos = le + 1
+                continue
+        else:
+            # look for the first match in the rest of the segment, then
+            # check the line if the match goes beyond it
+            span = regexp.searchSpan(buffer, pos, end)
+            if span is None:
+                break
+            ls = buffer.rfind(b'\n', pos, span[0]) + 1 or pos
+            le = buffer.find(b'\n', span[0], end)
+            le = end if le < 0 else le
+            if span[1] > le and regexp.searchSpan(view[ls:le]) is None:
+                pos = le + 1
+                continue
+
+        line = buffer[ls:le]
+        if lineNumbers:
+            lineno += buffer[counted:ls].count(b'\n')
+            counted = ls
+        if onlyMatching:
+            for m in regexp.finditer(line):
+                if m.end() > m.start():
+                    lines.append((lineno, m.group()))
+        else:
+            lines.append((lineno, line))
+        matches += 1
+        pos = le + 1
+
+    if lineNumbers:
+        lineno += buffer[counted:end].count(b'\n')
+    view.release()
+    return lines, lineno, matches
+
+def grepSegment(task:tuple) -> tuple[list, int, int, int]:
+    """ grepSegment scans the lines starting between start and end of a
+    file in a worker, the pattern is compiled once per process. it
+    returns the result of grepBuffer and the number of bytes scanned.
+    """
+    pattern, path, start, end, options = task
+    regexp = compile(pattern)
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return [], 0, 0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            start = lineStart(buffer, start)
+            end = lineStart(buffer, end)
+            lines, newlines, matches = grepBuffer(regexp, buffer, 
+                                                  start, end, options)
+            return lines, newlines, matches, end - start
+
+def grepWhole(task:tuple) -> tuple[list, int, int, int]:
+    """ grepWhole scans a file as one text, the matches may span lines,
+    they are returned as (offset, bytes).
+    """
+    pattern, path, _, _, _ = task
+    regexp = compile(pattern)
+    with open(path, 'rb') as f:
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return [], 0, 0, 0
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buffer:
+            matches = [(m.start(), m.group()) for m in 
+                       regexp.finditer(buffer) if m.end() > m.start()]
+            return matches, 0, len(matches), size
+
+def main(argv:list[str]=None, out=None) -> int:
+    """ main is the grep command, python -m re2 pattern files... the
+    exit status is 0 if a line matches, 1 if none does and 2 on errors.
+    """
+    parser = argparse.ArgumentParser(prog='python -m re2', description=
+        'print the lines of the files which match the pattern')
+    parser.add_argument('pattern')
+    parser.add_argument('files', nargs='+')
+    parser.add_argument('-n', '--line-number', action='store_true',
+                        help='print the line numbers')
+    parser.add_argument('-c', '--count', action='store_true',
+                        help='print the number of matching lines only')
+    parser.add_argument('-o', '--only-matching', action='store_true',
+                        help='print the matches instead of the lines')
+    parser.add_argument('-w', '--whole', action='store_true',
+                        help='match the whole file instead of each line, '
+                        'print the offsets and the matches')
+    parser.add_argument('-j', '--jobs', type=int, default=os.cpu_count(),
+                        help='the number of worker processes')
+    parser.add_argument('--segment-size', type=int, default=GREP_SEGMENT,
+                        help='the bytes of a file scanned by one task')
+    parser.add_argument('--stats', action='store_true',
+                        help='print the throughput to stderr')
+    args = parser.parse_args(argv)
+    out = out if out is not None else sys.stdout.buffer
+
+    try:
+        compile(args.pattern)
+    except Exception as e:
+        print(f'python -m re2: {e}', file=sys.stderr)
+        return 2
+
+    status = 1
+    tasks = []
+    files = [] # the index of the file of each task
+    options = (args.line_number, args.only_matching)
+    segment = max(args.segment_size, 1)
+    for k, path in enumerate(args.files):
+        try:
+            size = os.path.getsize(path)
+        except OSError as e:
+            print(f'python -m re2: {e}', file=sys.stderr)
+            status = 2
+            continue
+        # a match may span segments in the whole mode
+        bounds = range(0, size, segment) if not args.whole else [0]
+        for start in bounds or [0]:
+            tasks.append((args.pattern, path, start, start + segment, 
+                          options))
+            files.append(k)
+
+    began = time.perf_counter()
+    worker = grepWhole if args.whole else grepSegment
+    if args.jobs > 1 and len(tasks) > 1:
+        executor = ProcessPoolExecutor(args.jobs)
+        results = executor.map(worker, tasks)
+    else:
+        executor = None
+        results = map(worker, tasks)
+
+    total = scanned = 0
+    lineno = count = 0
+    try:
+        # map gives the results in the order of the tasks
+        for i, result in enumerate(results):
+            path = tasks[i][1]
+            name = path.encode() + b':' if len(args.files) > 1 else b''
+            lines, newlines, matches, nbytes = result
+            for number, line in lines:
+                if args.count:
+                    break
+                prefix = name
+                if args.whole:
+                    prefix += str(number).encode() + b':'
+                elif args.line_number:
+                    prefix += str(lineno + number + 1).encode() + b':'
+                out.write(prefix + line + b'\n')
+            lineno += newlines
+            count += matches
+            total += matches
+            scanned += nbytes
+            if i + 1 == len(tasks) or files[i+1] != files[i]:
+                if args.count:
+                    out.write(name + str(count).encode() + b'\n')
+                lineno = count = 0
+        out.flush()
+    except BrokenPipeError:
+        # the reader is gone (e.g. head), stop quietly as grep does
+        if out is sys.stdout.buffer:
+            os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+        return status if total == 0 else 0
+    finally:
+        if executor is not None:
+            executor.shutdown(cancel_futures=True)
+
+    if args.stats:
+        elapsed = time.perf_counter() - began
+        rate = scanned / elapsed / (1 << 20) if elapsed > 0 else 0
+        print(f'{len(args.files)} files, {scanned} bytes, {total} matches '
+              f'in {elapsed:.3f}s, {rate:.1f} MB/s', file=sys.stderr)
+    if total > 0 and status == 1:
+        status = 0
+    return status
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -1,8 +1,18 @@
 from re2 import RegExp
-from re2 import readUtf8
+from re2 import readUtf8, readText
+from re2 import NFAArc, CTX_NONE, CTX_BEGIN, CTX_END
 
+import re2
 import coverage
+import io
+import json
+import marshal
+import os
+import pickle
+import tempfile
+import tracemalloc
 import unittest
+from unittest import mock
 
 class TestSubstring(unittest.TestCase):
     def test_null_pattern(self):
@@ -59,6 +69,12 @@ class TestRepeat(unittest.TestCase):
         g = re.search('ABABcd')
         self.assertDictEqual(g, {0: [0, 0]})
 
+    def test_nongreedy_then_greedy(self):
+        # the token of '*' used to stay non-greedy after '*?'
+        re = RegExp('a*?b*')
+        g = re.search('bb')
+        self.assertDictEqual(g, {0: [0, 2]})
+
     def test_plus(self):
         re = RegExp('(ab)+')
         g = re.search('abababc')
@@ -149,6 +165,87 @@ class TestRepeat(unittest.TestCase):
         g = re.search('adadad')
         self.assertEqual(g, {0: [0, 6], 1: [0, 1]})
 
+    def test_optional_repeats(self):
+        re = RegExp('(a|b){0,2}c')
+        self.assertEqual(re.search('abc'), {0: [0, 3], 1: [0, 1]})
+        self.assertEqual(re.search('c'), {0: [0, 1]})
+        self.assertIsNone(RegExp('^(a|b){0,2}c').search('abac'))
+
+    def test_counted_repeats(self):
+        re = RegExp('a{1,10000}')
+        re.search('')
+        # the fragment is not copied 10000 times
+        self.assertLess(len(re.prog), 10)
+        self.assertEqual(re.prog.repeats, [(1, 10000)])
+        self.assertEqual(re.search('baaab'), {0: [1, 4]})
+
+    def test_counted_bounds(self):
+        re = RegExp(r'x\d{3,200}y')
+        self.assertIsNone(re.search('x12y'))
+        self.assertEqual(re.search('x123y'), {0: [0, 5]})
+        self.assertEqual(re.search('x' + '1' * 200 + 'y'), {0: [0, 202]})
+        self.assertIsNone(re.search('x' + '1' * 201 + 'y'))
+
+    def test_counted_group(self):
+        re = RegExp(r'(\w+\.){3,50}x')
+        self.assertIsNone(re.search('a.b.x'))
+        self.assertEqual(re.search('-a.b.c.d.x'), {0: [1, 10], 1: [1, 3]})
+
+    def test_counted_nongreedy(self):
+        re = RegExp('ab{3,500}?')
+        self.assertEqual(re.search('abbbbb'), {0: [0, 4]})
+        re = RegExp('ab{3,500}?c')
+        self.assertEqual(re.search('abbbbbc'), {0: [0, 7]})
+
+    def test_counted_infinite(self):
+        re = RegExp('ab{300,}c')
+        self.assertIsNone(re.search('a' + 'b' * 299 + 'c'))
+        self.assertEqual(re.search('a' + 'b' * 400 + 'c'), {0: [0, 402]})
+
+    def test_counted_span(self):
+        re = RegExp('b{3,200}')
+        self.assertEqual(re.searchSpan('abbbbc'), (1, 5))
+        self.assertEqual(re.searchSpan('abbc'), None)
+
+    def test_counted_dumps(self):
+        re = RegExp('(ab){2,1000}')
+        re2 = RegExp.loads(re.dumps())
+        self.assertEqual(re2.prog.repeats, [(2, 1000)])
+        self.assertEqual(re2.search('xababab'), {0: [1, 7], 1: [1, 3]})
+
+    def test_counted_renew(self):
+        re = RegExp('[ab]{1,500}c')
+        re.compile()
+        re.dfa.maxMemory = 10000
+        self.assertIsNone(re.search('c' + 'a' * 200))
+        prog = re.prog
+        self.assertGreater(prog.configMemory, 10000)
+        # the configurations are dropped before the next search
+        self.assertEqual(re.search('xabc'), {0: [1, 4]})
+        self.assertIsNot(re.prog, prog)
+        self.assertLess(len(re.prog.configs), 10)
+        self.assertEqual(re.dfa.maxMemory, 10000)
+
+    def test_repeat_limit(self):
+        re = RegExp('^a{65535}')
+        self.assertIsNone(re.search('a' * 100))
+        self.assertEqual(re.prog.repeats, [(65535, 65535)])
+        with self.assertRaises(Exception):
+            RegExp('a{65536}').search('')
+
+    def test_nullable_limit(self):
+        # the repeats of a fragment matching '' are copied, not counted
+        self.assertEqual(RegExp('(a?){50}').search('a' * 60), 
+                         {0: [0, 50], 1: [0, 1]})
+        re = RegExp('(((([^a])|(cab)??c([^a]){2}.)?)){50}')
+        self.assertEqual(re.search('xx'), {0: [0, 2], 1: [0, 1], 2: [0, 1],
+                                           3: [0, 1], 4: [0, 1]})
+        self.assertEqual(RegExp('((b|cd)?){2,99}').search('bcdbx'), 
+                         {0: [0, 4], 1: [0, 1], 2: [0, 1]})
+        for pattern in ('(x?){5000}', '(a|b*){65535}', '(a?){1000,}'):
+            with self.assertRaises(Exception):
+                RegExp(pattern).compile()
+
 
 class TestAlternation(unittest.TestCase):
     def test_simple_alt(self):
@@ -194,6 +291,24 @@ class TestCharacterClass(unittest.TestCase):
         g = re.search('hello, world')
         self.assertEqual(g, {0: [5, 7]})
 
+    def test_normalize(self):
+        r = re2.Range([(97, 122), (48, 57), (95, 95), (90, 96)])
+        self.assertEqual(r.ranges, [(48, 57), (90, 122)])
+        r = re2.Range([(48, 57)], True)
+        self.assertEqual((r.ranges, r.negate), ([(0, 47), (58, 0x10ffff)], False))
+        self.assertTrue(r.match(0x4e00) and r.match(127) and not r.match(50))
+
+    def test_hyphen(self):
+        self.assertEqual(RegExp('[a-c-e]+').search('x-ecd'), {0: [1, 4]})
+        self.assertEqual(RegExp('[a-]+').search('x-a'), {0: [1, 3]})
+        self.assertEqual(RegExp('-a').search('b-a'), {0: [1, 3]})
+
+    def test_shared(self):
+        re = RegExp('.[0-9].\\d')
+        re.compile()
+        self.assertEqual(len(re.ranges), 2)
+        self.assertEqual(len(re.prog.classes), 2)
+
 
 class TestUnicode(unittest.TestCase):
     def test_jp(self):
@@ -206,6 +321,37 @@ class TestUnicode(unittest.TestCase):
         g = re.search('我我我我')
         self.assertEqual(g, {0: [0, 4]})
 
+    def test_read_utf8_4bytes(self):
+        self.assertEqual(readUtf8('😀'), ord('😀'))
+
+    def test_astral(self):
+        re = RegExp('😀+')
+        g = re.search('a😀😀b')
+        self.assertEqual(g, {0: [1, 3]})
+
+    def test_read_text(self):
+        self.assertEqual(list(readText('a我😀')), [97, 0x6211, 0x1f600])
+        data = bytearray(b'abc')
+        self.assertIs(readText(data).obj, data)
+
+
+class TestBytes(unittest.TestCase):
+    def test_bytes(self):
+        re = RegExp('(\\d+)-(\\d+)')
+        m = re.exec(b'tel: 1234-567')
+        self.assertEqual(m.span(), (5, 13))
+        self.assertEqual(m.group(1), b'1234')
+
+    def test_bytearray(self):
+        re = RegExp('b+')
+        g = re.search(bytearray(b'abbbc'))
+        self.assertEqual(g, {0: [1, 4]})
+
+    def test_bytes_span(self):
+        re = RegExp('[^a-z]+')
+        g = re.searchSpan(b'hello, world')
+        self.assertEqual(g, (5, 7))
+
 
 class TestAnchor(unittest.TestCase):
     def test_anchor_begin(self):
@@ -233,6 +379,790 @@ class TestAnchor(unittest.TestCase):
         g = re.search('abc')
         self.assertEqual(g, {0: [0, 3]})
 
+    def test_quest_at_end(self):
+        re = RegExp('x(a?)')
+        g = re.search('x')
+        self.assertEqual(g, {0: [0, 1], 1: [1, 1]})
+
+
+class TestClosure(unittest.TestCase):
+    def test_closure_ops(self):
+        re = RegExp('(a)|b')
+        re.compile()
+        closure = re.prog.closures[CTX_NONE][0]
+        self.assertEqual([value for _, _, value, _ in closure], [97, 98])
+        self.assertEqual(closure[0][0], ((NFAArc.LGROUP, 1),))
+        self.assertEqual(closure[1][0], ())
+
+    def test_closure_anchor(self):
+        re = RegExp('^a')
+        re.compile()
+        self.assertEqual(re.prog.closures[CTX_NONE][0], [])
+        self.assertEqual(len(re.prog.closures[CTX_BEGIN][0]), 1)
+
+    def test_closure_accept(self):
+        re = RegExp('a*')
+        re.compile()
+        closure = re.prog.closures[CTX_END][0]
+        self.assertEqual(len(closure), 1)
+        self.assertEqual(closure[0][1], NFAArc.EPSILON)
+        self.assertEqual(closure[0][3], re.prog.accept)
+
+    def test_closure_lazy(self):
+        re = RegExp('(a?)' * 150)
+        re.compile()
+        closures = re.prog.closures
+        # no anchor, the beginning of the text shares the tables
+        self.assertIs(closures[CTX_BEGIN], closures[CTX_NONE])
+        self.assertLess(len(closures[CTX_NONE]), 10)
+        self.assertEqual(re.search('aa')[0], [0, 2])
+        self.assertLess(len(closures[CTX_NONE]), len(re.prog))
+
+
+class TestProgram(unittest.TestCase):
+    def test_program_arrays(self):
+        re = RegExp('a(b|c)')
+        re.compile()
+        prog = re.prog
+        self.assertEqual(len(prog.first), len(prog) + 1)
+        self.assertEqual(len(prog.types), prog.first[-1])
+        self.assertEqual(len(prog.values), len(prog.targets))
+        self.assertEqual(prog.groups, 1)
+
+    def test_interned_classes(self):
+        re = RegExp('\\d.\\d.')
+        re.compile()
+        self.assertEqual(len(re.prog.classes), 2)
+
+    def test_sizeof(self):
+        small = RegExp('abc')
+        large = RegExp('abc' * 50)
+        small.compile()
+        large.compile()
+        self.assertLess(small.prog.sizeof(), large.prog.sizeof())
+
+    def test_sizeof_traced(self):
+        for pattern in ('abc', '(a?)' * 40, '[ab]{1,500}c', '\\d+(x|y)'):
+            packed = RegExp(pattern).dumps()
+            tracemalloc.start()
+            try:
+                before = tracemalloc.get_traced_memory()[0]
+                prog = RegExp.loads(packed).prog
+                size = prog.sizeof()
+                for closures in prog.closures:
+                    for i in range(len(prog)):
+                        closures[i]
+                # the closures are counted once they're computed
+                self.assertGreaterEqual(prog.sizeof(), size)
+                traced = tracemalloc.get_traced_memory()[0] - before
+            finally:
+                tracemalloc.stop()
+            self.assertLess(prog.sizeof(), traced * 2)
+            self.assertGreater(prog.sizeof(), traced / 2)
+
+
+class TestOptimize(unittest.TestCase):
+    def test_serialize_identity(self):
+        # states with the same arcs are still different states
+        nfa = re2.NFA()
+        start, a, b = nfa.newState(), nfa.newState(), nfa.newState()
+        start.appendArc(a, ord('a'), NFAArc.CHAR)
+        start.appendArc(b, ord('b'), NFAArc.CHAR)
+        nodes = nfa.serialize(start)
+        self.assertEqual(len(nodes), 3)
+        self.assertEqual([a.index, b.index], [1, 2])
+
+    def test_bypass(self):
+        re = RegExp('a|b')
+        re.compile()
+        # the ends of the branches go to the accept state directly
+        self.assertEqual(len(re.prog), 4)
+        self.assertEqual(re.prog.targets[2], re.prog.targets[3])
+
+    def test_merge(self):
+        re = RegExp('xa|ya')
+        re.compile()
+        self.assertEqual(len(re.prog), 5)
+        self.assertEqual(re.search('zya'), {0: [1, 3]})
+
+    def test_anchor_target(self):
+        # the target of $ is shared with the one of ^
+        re = RegExp('($|(a|^))')
+        self.assertEqual(re.search('bbb'), {0: [0, 0], 1: [0, 0], 2: [0, 0]})
+
+    def test_large_alternation(self):
+        words = ['w%dx%d' % (i, i * 7) for i in range(1000)]
+        re = RegExp('|'.join(words))
+        re.compile()
+        self.assertLess(len(re.prog), sum(map(len, words)))
+        self.assertEqual(re.searchSpan('--w999x6993--'), (2, 11))
+        self.assertIsNone(re.searchSpan('w12x85'))
+
+
+class TestMatch(unittest.TestCase):
+    def test_match_groups(self):
+        re = RegExp('(\\d+)-(\\d+)')
+        m = re.exec('tel: 1234-567')
+        self.assertEqual(m.span(), (5, 13))
+        self.assertEqual(m.group(), '1234-567')
+        self.assertEqual(m.group(1, 2), ('1234', '567'))
+        self.assertEqual(m.groups(), ('1234', '567'))
+        self.assertEqual(m[2], '567')
+
+    def test_match_unset_group(self):
+        re = RegExp('(a)|(b)')
+        m = re.exec('b')
+        self.assertEqual(m.span(1), (-1, -1))
+        self.assertEqual(m.groups('-'), ('-', 'b'))
+        self.assertEqual(m.spans(), {0: [0, 1], 2: [0, 1]})
+
+    def test_match_none(self):
+        re = RegExp('abc')
+        self.assertIsNone(re.exec('abd'))
+
+
+class TestLiteral(unittest.TestCase):
+    def test_prefix(self):
+        re = RegExp('ERROR: (\\w+)')
+        re.compile()
+        self.assertEqual(re.prog.prefix, tuple(map(ord, 'ERROR: ')))
+        g = re.search('INFO: ok\nERROR: disk')
+        self.assertEqual(g, {0: [9, 20], 1: [16, 20]})
+
+    def test_first_chars(self):
+        re = RegExp('(ab|cd)e')
+        re.compile()
+        self.assertEqual(re.prog.prefix, ())
+        self.assertEqual(re.prog.firstChars, {97, 99})
+        self.assertEqual(re.searchSpan('xxabxcde'), (5, 8))
+
+    def test_no_prefix(self):
+        re = RegExp('\\w*b')
+        re.compile()
+        self.assertEqual(re.prog.prefix, ())
+        self.assertIsNone(re.prog.firstChars)
+
+    def test_prefix_not_in_bytes(self):
+        re = RegExp('我+')
+        self.assertIsNone(re.exec(b'abc'))
+        self.assertIsNone(re.searchSpan(bytearray(b'abc')))
+
+
+class TestPrefilter(unittest.TestCase):
+    def test_required(self):
+        re = RegExp('\\d+ms timeout (\\w+)')
+        re.compile()
+        self.assertEqual(re.prog.required, (tuple(map(ord, 'ms timeout ')),))
+
+    def test_required_several(self):
+        re = RegExp('a(b|c)de')
+        re.compile()
+        self.assertEqual(set(re.prog.required), {(100, 101), (97,)})
+
+    def test_prefilter(self):
+        re = RegExp('\\d+ms timeout (\\w+)')
+        self.assertFalse(re.prefilter('12ms elapsed'))
+        self.assertTrue(re.prefilter('12ms timeout db'))
+        self.assertFalse(re.prefilter('12ms timeout db', 5))
+        self.assertIsNone(re.search('12ms elapsed'))
+        self.assertEqual(re.search(b'x 12ms timeout db'), 
+                         {0: [2, 17], 1: [15, 17]})
+
+    def test_prefilter_optional(self):
+        re = RegExp('x(y)?z')
+        self.assertTrue(re.prefilter('xz'))
+        self.assertEqual(re.search('xz'), {0: [0, 2]})
+
+
+class TestLazyDFA(unittest.TestCase):
+    def test_span(self):
+        re = RegExp('(\\d+)-(\\d+)')
+        g = re.searchSpan('tel: 1234-567')
+        self.assertEqual(g, (5, 13))
+
+    def test_span_leftmost_first(self):
+        re = RegExp('(a|ab)(c|bcd)')
+        g = re.searchSpan('xabcd')
+        self.assertEqual(g, (1, 5))
+
+    def test_span_nomatch(self):
+        re = RegExp('^abc')
+        g = re.searchSpan('dabc')
+        self.assertIsNone(g)
+
+    def test_span_same_as_search(self):
+        for pattern in ('(AB)*', '(a??)*', 'ab{3,5}?', 'abc$', '[^a-z]+'):
+            re = RegExp(pattern)
+            for text in ('', 'ABAB', 'abbbbbc', 'xabc', 'hello, world'):
+                g = re.search(text)
+                self.assertEqual(re.searchSpan(text), 
+                                 tuple(g[0]) if g else None)
+
+    def test_state_cache(self):
+        re = RegExp('a+b')
+        re.searchSpan('aaab' * 100)
+        states = len(re.dfa.states)
+        re.searchSpan('aaaaab' * 100)
+        self.assertEqual(len(re.dfa.states), states)
+
+    def test_lazy_reverse(self):
+        # the reverse DFA is built once a match is searched backwards
+        re = RegExp('(a|b)*c')
+        self.assertEqual(re.match('abc').span(), (0, 3))
+        self.assertEqual(re.fullmatch('abc').span(), (0, 3))
+        self.assertIsNone(re.rdfa)
+        self.assertEqual(re.explain()['cache']['reverse']['states'], 0)
+        self.assertEqual(re.searchSpan('x' * 100 + 'abc'), (100, 103))
+        self.assertIsNotNone(re.rdfa)
+        self.assertGreater(re.explain()['cache']['reverse']['states'], 0)
+
+    def test_cache_fallback(self):
+        re = RegExp('(a|b)*c')
+        re.compile()
+        re.dfa.maxStates = 1
+        g = re.searchSpan('ababc')
+        self.assertEqual(g, (0, 5))
+        self.assertGreater(re.dfa.flushes, 0)
+
+    def test_memory(self):
+        re = RegExp('(a|b)*a(a|b){5}c')
+        re.compile()
+        re.dfa.maxMemory = 20000
+        # all the words of 7 letters, so the DFA needs many states
+        text = ''.join(format(i, '07b') for i in range(128))
+        text = text.replace('0', 'a').replace('1', 'b') + 'aaaaaac'
+        self.assertEqual(re.searchSpan(text), (0, len(text)))
+        self.assertGreater(re.dfa.flushes, 0)
+        self.assertLessEqual(re.dfa.memory, 20000)
+        info = re.explain()['cache']['forward']
+        self.assertEqual(info['maxMemory'], 20000)
+        self.assertEqual(info['memory'], re.dfa.memory)
+
+    def test_fallback_for_good(self):
+        re = RegExp('(a|b)*c')
+        re.compile()
+        re.dfa.maxMemory = 1 # not even one state
+        for _ in range(RegExp.MAX_FALLBACKS):
+            self.assertEqual(re.searchSpan('xababc'), (1, 6))
+        self.assertEqual(re.explain()['scan'], 'nfa')
+        self.assertEqual(re.explain()['cache']['fallbacks'], 
+                         RegExp.MAX_FALLBACKS)
+        self.assertEqual(re.search('xababc'), {0: [1, 6], 1: [1, 2]})
+
+    def test_budget(self):
+        budget = re2.DFABudget(36000)
+        first = RegExp('(a|b)*a(a|b){5}c')
+        second = RegExp('(c|d)*c(c|d){5}e')
+        first.compile()
+        second.compile()
+        dfa1 = re2.LazyDFA(first.prog, budget=budget)
+        dfa2 = re2.LazyDFA(second.prog, budget=budget)
+        self.assertEqual(dfa1.searchEnd(re2.readText('ab' * 100 + 'aaaaaac')), 207)
+        used = budget.memory
+        self.assertEqual(used, dfa1.memory)
+        text = ''.join(format(i, '07b') for i in range(128))
+        dfa2.searchEnd(re2.readText(text.replace('0', 'c').replace('1', 'd')))
+        # the least recently used cache makes room
+        self.assertGreater(dfa1.flushes, 0)
+        self.assertLessEqual(budget.memory, 36000)
+        self.assertEqual(budget.info().flushes, dfa1.flushes)
+        self.assertEqual(budget.memory, dfa1.memory + dfa2.memory)
+        del dfa2 # its memory is given back
+        self.assertEqual(budget.memory, dfa1.memory)
+
+    def test_global_budget(self):
+        maxMemory = re2.dfaCacheInfo().maxMemory
+        try:
+            re2.setDFAMemory(0)
+            self.assertEqual(re2.dfaCacheInfo().memory, 0)
+            self.assertEqual(RegExp('(a|b)*c').searchSpan('x' * 10 + 'abc'),
+                             (10, 13))
+        finally:
+            re2.setDFAMemory(maxMemory)
+
+
+class TestLocate(unittest.TestCase):
+    def test_groups_on_span(self):
+        re = RegExp('(\\w+)=(\\d+)')
+        text = '-' * 1000 + 'id=42' + '-' * 1000
+        m = re.exec(text)
+        self.assertEqual(m.span(), (1000, 1005))
+        self.assertEqual(m.groups(), ('id', '42'))
+
+    def test_threads_stop_at_end(self):
+        re = RegExp('(a)(b*)')
+        re.compile()
+        codes = re2.readText('xabbbb')
+        # the match is known to end at 3
+        self.assertEqual(re.simulate(codes, 1, None, True, stop=3),
+                         (1, 3, 1, 2, 2, 3))
+
+    def test_absolute_anchors(self):
+        re = RegExp('(^a|b)(c$|c)')
+        self.assertEqual(re.search('acxbc'), {0: [0, 2], 1: [0, 1], 2: [1, 2]})
+        self.assertEqual(re.search('acxbc', 1), {0: [3, 5], 1: [3, 4], 2: [4, 5]})
+
+    def test_no_groups(self):
+        re = RegExp('a+b')
+        self.assertEqual(re.exec('xaab').span(), (1, 4))
+        self.assertEqual(re.findall('ab aab'), ['ab', 'aab'])
+
+    def test_empty_after_empty(self):
+        re = RegExp('(a?)')
+        self.assertEqual([m.span() for m in re.finditer('ba')],
+                         [(0, 0), (1, 2), (2, 2)])
+
+    def test_cache_fallback_groups(self):
+        re = RegExp('(a|b)*(c)')
+        re.compile()
+        re.dfa.maxStates = 1
+        self.assertEqual(re.search('ababc'), {0: [0, 5], 1: [0, 1], 2: [4, 5]})
+
+
+class TestOnePass(unittest.TestCase):
+    def test_detect(self):
+        for pattern in ('(\\d+)-(\\d+)', 'key=(\\w+);', '(a|b)*c', '^a$'):
+            re = RegExp(pattern)
+            re.compile()
+            self.assertTrue(re.prog.onepass, pattern)
+        for pattern in ('(a|ab)c', 'a*a', '(ab|ac)', 'a{1,1000}'):
+            re = RegExp(pattern)
+            re.compile()
+            self.assertFalse(re.prog.onepass, pattern)
+
+    def test_match(self):
+        re = RegExp('(\\d+)-(\\d+)')
+        self.assertEqual(re.match('12-345x').groups(), ('12', '345'))
+        self.assertIsNone(re.match('x12-345'))
+        self.assertEqual(re.exec('tel 12-345').span(2), (7, 10))
+
+    def test_accept_kept(self):
+        # the arcs taken after the accept state fail
+        re = RegExp('(\\d+)(-\\d+)?')
+        m = re.match('12-x')
+        self.assertEqual(m.span(), (0, 2))
+        self.assertEqual(m.groups(), ('12', None))
+
+    def test_fullmatch(self):
+        re = RegExp('(a+)b?')
+        self.assertEqual(re.fullmatch('aab').span(1), (0, 2))
+        self.assertIsNone(re.fullmatch('aabx'))
+
+    def test_same_as_threads(self):
+        re = RegExp('(a|bc)*(d?)$')
+        re.compile()
+        self.assertTrue(re.prog.onepass)
+        for text in ('', 'abcd', 'abca', 'bcbcd', 'xad'):
+            codes = readText(text)
+            for pos in range(len(text) + 1):
+                self.assertEqual(re.onePass(codes, pos),
+                                 re.simulate(codes, pos, None, True))
+
+    def test_loads(self):
+        re = RegExp.loads(RegExp('k=(\\d+);').dumps())
+        self.assertTrue(re.prog.onepass)
+        self.assertEqual(re.exec('a k=12;').group(1), '12')
+
+
+class TestBacktrack(unittest.TestCase):
+    def test_same_as_threads(self):
+        for pattern in ('(a|ab)(c|bcd)(d*)', '(a?)*', '(a*?)(b+)?$', '^(x|)+'):
+            re = RegExp(pattern)
+            re.compile()
+            for text in ('', 'abcd', 'aab', 'xxb', 'abcdd'):
+                codes = readText(text)
+                for pos in range(len(text) + 1):
+                    for anchorStart in (False, True):
+                        self.assertEqual(
+                            re.backtrack(codes, pos, None, anchorStart),
+                            re.simulate(codes, pos, None, anchorStart))
+
+    def test_chosen(self):
+        re = RegExp('(a|ab)(c|bcd)')
+        re.compile()
+        self.assertTrue(re.canBacktrack(0, 100))
+        self.assertFalse(re.canBacktrack(0, re.BACKTRACK_BITS))
+        self.assertFalse(re.canBacktrack(5, 4))
+
+    def test_budget(self):
+        re = RegExp('(a|ab)(c|bcd)')
+        re.BACKTRACK_BITS = 0
+        self.assertEqual(re.exec('xabcd').groups(), ('a', 'bcd'))
+        self.assertEqual(re.match('abcd').groups(), ('a', 'bcd'))
+
+    def test_linear(self):
+        # a plain backtracker takes exponential time here
+        re = RegExp('(a*)*b')
+        self.assertIsNone(re.match('a' * 200))
+        self.assertEqual(re.exec('a' * 200 + 'b').span(), (0, 201))
+
+
+class TestPlan(unittest.TestCase):
+    def test_literal(self):
+        re = RegExp('hello')
+        self.assertEqual(re.explain()['scan'], 'literal')
+        self.assertEqual(re.exec('say hello').span(), (4, 9))
+        self.assertEqual(re.exec(b'say hello', 0, 8), None)
+        self.assertEqual(re.findall('hellohello'), ['hello', 'hello'])
+        self.assertEqual(RegExp('(hello)').explain()['scan'], 'dfa')
+
+    def test_anchored(self):
+        re = RegExp('^(a|b)c')
+        self.assertEqual(re.explain()['scan'], 'anchored')
+        self.assertEqual(re.exec('bcd').groups(), ('b',))
+        self.assertIsNone(re.exec('xbc'))
+        self.assertIsNone(re.exec('bcbc', 2))
+
+    def test_capture(self):
+        self.assertEqual(RegExp('(\\d+)-(\\d+)').explain()['capture'], 
+                         'onepass')
+        self.assertEqual(RegExp('(a|ab)(c|bcd)').explain()['capture'], 
+                         'backtrack')
+        self.assertEqual(RegExp('(a){2,300}').explain()['capture'], 'nfa')
+
+    def test_counters(self):
+        re = RegExp('xa{20000}')
+        self.assertEqual(re.explain()['scan'], 'nfa')
+        self.assertEqual(re.exec('yx' + 'a' * 20000).span(), (1, 20002))
+
+    def test_force(self):
+        re = RegExp('(a|ab)(c|bcd)')
+        re.compile()
+        re.plan.scan = 'nfa'
+        re.plan.capture = 'nfa'
+        self.assertEqual(re.exec('xabcd').groups(), ('a', 'bcd'))
+
+    def test_explain(self):
+        plan = RegExp('(\\w+)@example\\.com').explain()
+        self.assertEqual(plan['groups'], 1)
+        self.assertEqual(plan['required'], ['@example.com'])
+        self.assertEqual(plan['prefix'], '')
+        self.assertGreater(plan['backtrack'], 0)
+        self.assertEqual(plan['cost']['scan'], 1)
+
+
+class TestStats(unittest.TestCase):
+    def test_hook(self):
+        found = []
+        re = RegExp('(a|ab)(c|bcd)')
+        self.assertIsNone(re.hook)
+        re.setHook(found.append)
+        self.assertEqual(re.exec('xabcd').groups(), ('a', 'bcd'))
+        stats = found[0]
+        self.assertEqual(stats.searches, 1)
+        self.assertGreater(stats.positions, 0)
+        self.assertGreater(stats.closures, 0)
+        self.assertGreater(stats.copies, 0)
+        self.assertEqual(set(stats.times), {'prefilter', 'scan', 'capture'})
+        re.setHook(None)
+        re.exec('xabcd')
+        self.assertEqual(len(found), 1)
+
+    def test_prefilter(self):
+        found = []
+        re = RegExp('(\\w+)@example')
+        re.setHook(found.append)
+        self.assertIsNone(re.exec('no address'))
+        self.assertEqual(found[0].positions, 0)
+        self.assertEqual(found[0].threads, 0)
+
+    def test_threads(self):
+        found = []
+        re = RegExp('(a|ab)(c|bcd)')
+        re.compile()
+        re.plan.capture = 'nfa'
+        re.setHook(found.append)
+        self.assertEqual(re.exec('xabcd').groups(), ('a', 'bcd'))
+        self.assertGreater(found[0].peakThreads, 1)
+        self.assertGreater(found[0].times['capture'], 0)
+
+    def test_profile(self):
+        profile = re2.Profile()
+        words = RegExp('[a-z]+')
+        digits = RegExp('(\\d+)')
+        words.setHook(profile)
+        digits.setHook(profile)
+        self.assertEqual(len(words.findall('ab cd ef')), 3)
+        digits.exec('x12')
+        digits.match('12')
+        report = {s['pattern']: s for s in profile.report()}
+        # one search per match and one which finds nothing
+        self.assertEqual(report['[a-z]+']['searches'], 4)
+        self.assertEqual(report['(\\d+)']['searches'], 2)
+        self.assertGreaterEqual(report['[a-z]+']['positions'], 8)
+        profile.clear()
+        self.assertEqual(profile.report(), [])
+
+
+class TestAlphabet(unittest.TestCase):
+    def classOf(self, prog, c):
+        return prog.classOf(c)
+
+    def test_classes(self):
+        re = RegExp('a[b-d]x|.')
+        re.compile()
+        prog = re.prog
+        self.assertEqual(prog.alphabetSize, 4)
+        self.assertEqual(self.classOf(prog, ord('b')), self.classOf(prog, ord('d')))
+        self.assertEqual(self.classOf(prog, ord('e')), self.classOf(prog, 0x10ffff))
+        self.assertNotEqual(self.classOf(prog, ord('a')), self.classOf(prog, ord('x')))
+
+    def test_shared_pages(self):
+        re = RegExp('[\u4e00-\u9fff]+')
+        re.compile()
+        self.assertEqual(re.prog.alphabetSize, 2)
+        self.assertEqual(len(re.prog.pages), 2)
+
+    def test_short_top(self):
+        # the blocks after the last bound share a page
+        re = RegExp('[a-z]+\\d')
+        re.compile()
+        prog = re.prog
+        self.assertEqual(len(prog.top), 1)
+        self.assertLess(prog.sizeof(), 12 * 1024) # not 8.7KB of top alone
+        self.assertEqual(prog.classOf(0x4e00), prog.classOf(ord('{')))
+        self.assertEqual(prog.classOf(0x10ffff), prog.classOf(0))
+        re = RegExp('[\u4e00-\u9fff]x')
+        re.compile()
+        self.assertEqual(len(re.prog.top), (0xa000 >> 8) + 1)
+        self.assertEqual(re.prog.classOf(0x9fff), re.prog.classOf(0x4e00))
+        self.assertEqual(re.prog.classOf(0xa000), re.prog.classOf(0x10000))
+
+    def test_dfa_transitions(self):
+        re = RegExp('[a-z]+\\d')
+        re.searchSpan('\u4e00\u4e01\u4e02abc1')
+        for state in re.dfa.states.values():
+            self.assertEqual(len(state.next), re.prog.alphabetSize)
+
+
+class TestAnchoredMatch(unittest.TestCase):
+    def test_match(self):
+        re = RegExp('a+')
+        self.assertIsNone(re.match('baa'))
+        self.assertEqual(re.match('baa', 1).span(), (1, 3))
+
+    def test_fullmatch(self):
+        re = RegExp('a|ab')
+        self.assertEqual(re.fullmatch('ab').span(), (0, 2))
+        self.assertIsNone(re.fullmatch('abc'))
+
+    def test_fullmatch_groups(self):
+        re = RegExp('(a*)(ab)?b')
+        m = re.fullmatch('aab')
+        self.assertEqual(m.groups(), ('aa', None))
+
+
+class TestModule(unittest.TestCase):
+    def setUp(self):
+        re2.purge()
+
+    def tearDown(self):
+        re2.setCacheSize(re2.PatternCache.MAX_SIZE)
+
+    def test_functions(self):
+        self.assertEqual(re2.search('b+', 'abbc').span(), (1, 3))
+        self.assertIsNone(re2.match('b+', 'abbc'))
+        self.assertEqual(re2.fullmatch('ab+c', 'abbc').span(), (0, 4))
+
+    def test_cache(self):
+        self.assertIs(re2.compile('a(b)c'), re2.compile('a(b)c'))
+        info = re2.cacheInfo()
+        self.assertEqual((info.hits, info.misses, info.currsize), (1, 1, 1))
+
+    def test_cache_size(self):
+        re2.setCacheSize(2)
+        for pattern in ('a', 'b', 'c'):
+            re2.compile(pattern)
+        re2.compile('a')
+        info = re2.cacheInfo()
+        self.assertEqual((info.misses, info.currsize), (4, 2))
+
+    def test_purge(self):
+        re2.compile('a')
+        re2.purge()
+        self.assertEqual(re2.cacheInfo().currsize, 0)
+
+
+class TestSerialize(unittest.TestCase):
+    def test_roundtrip(self):
+        re = RegExp.loads(RegExp('(\\d+):([a-z]+)').dumps())
+        self.assertIsNone(re.tokenizer)
+        self.assertEqual(re.search('x 12:ab'), {0: [2, 7], 1: [2, 4], 2: [5, 7]})
+
+    def test_invalid(self):
+        with self.assertRaises(ValueError):
+            RegExp.loads(b'garbage')
+        data = marshal.dumps((RegExp.MAGIC, RegExp.VERSION + 1, 'a', ()))
+        with self.assertRaises(ValueError):
+            RegExp.loads(data)
+
+    def test_cache_dir(self):
+        with tempfile.TemporaryDirectory() as directory:
+            re2.purge()
+            re2.setCacheDir(directory)
+            try:
+                re2.compile('a(b+)c')
+                self.assertEqual(len(os.listdir(directory)), 1)
+                re2.purge()
+                re = re2.compile('a(b+)c')
+                self.assertIsNone(re.tokenizer) # loaded, not parsed
+                self.assertEqual(re.exec('abbc').group(1), 'bb')
+            finally:
+                re2.setCacheDir(None)
+
+
+class TestRegexSet(unittest.TestCase):
+    def test_matches(self):
+        rs = re2.RegexSet(['abc', '\\d+', '^x', 'y$', 'zz'])
+        self.assertEqual(rs.matches('xxabc 12 y'), [0, 1, 2, 3])
+        self.assertEqual(rs.matches('a zz'), [4])
+        self.assertEqual(rs.matches(b'12'), [1])
+        self.assertEqual(re2.RegexSet([]).matches('abc'), [])
+
+    def test_spans(self):
+        rs = re2.RegexSet(['b+', 'a|c', 'd'])
+        self.assertEqual(rs.spans('xbbc'), {0: (1, 3), 1: (3, 4)})
+
+    def test_union(self):
+        rs = re2.RegexSet(['a[0-9]', 'b[0-9]', ''])
+        self.assertEqual(len(rs.prog.classes), 1)
+        self.assertEqual(sorted(rs.prog.tags.values()), [0, 1, 2])
+        self.assertEqual(rs.matches(''), [2])
+
+
+class TestFindIter(unittest.TestCase):
+    def test_finditer(self):
+        re = RegExp('a+')
+        it = re.finditer('baaca')
+        self.assertEqual(next(it).span(), (1, 3))
+        self.assertEqual([m.span() for m in it], [(4, 5)])
+        self.assertEqual([m.span() for m in re.finditer(b'aba', 1)], [(2, 3)])
+
+    def test_empty(self):
+        self.assertEqual(re2.findall('\\d*', 'a12b'), ['', '12', '', ''])
+        self.assertEqual(re2.findall('a*|b', 'b'), ['', 'b', ''])
+        self.assertEqual(re2.findall('a??', 'aa'), ['', 'a', '', 'a', ''])
+        self.assertEqual(re2.findall('', ''), [''])
+
+    def test_findall_groups(self):
+        self.assertEqual(re2.findall('\\w+', 'a bc'), ['a', 'bc'])
+        self.assertEqual(re2.findall('(a)b', 'abab'), ['a', 'a'])
+        self.assertEqual(re2.findall('(a)(b)?', 'aba'), [('a', 'b'), ('a', '')])
+
+
+class TestStream(unittest.TestCase):
+    def test_chunks(self):
+        stream = RegExp('a(b+)c').stream()
+        self.assertEqual(stream.feed('xab'), [])
+        self.assertEqual(stream.feed('b'), [])
+        m, = stream.feed('cyab')
+        self.assertEqual((m.span(), m.group(1)), ((1, 5), 'bb'))
+        self.assertEqual([m.span() for m in stream.feed('cz')], [(6, 9)])
+        self.assertEqual(stream.flush(), [])
+
+    def test_pending(self):
+        # the match of 'a' is only known when 'abc' fails
+        stream = RegExp('ab*c|a').stream()
+        self.assertEqual(stream.feed('abb'), [])
+        self.assertEqual(stream.buffer, 'abb')
+        spans = [m.span() for m in stream.feed('xa')]
+        self.assertEqual(spans, [(0, 1)])
+        self.assertEqual([m.span() for m in stream.flush()], [(4, 5)])
+
+    def test_end(self):
+        stream = RegExp('b*$').stream()
+        self.assertEqual(stream.feed(b'abb'), [])
+        m1, m2 = stream.flush()
+        self.assertEqual((m1.span(), m1.group(), m2.span()), ((1, 3), b'bb', (3, 3)))
+        self.assertEqual([m.span() for m in stream.flush()], [(0, 0)])
+
+
+class TestGrep(unittest.TestCase):
+    def grep(self, *argv):
+        out = io.BytesIO()
+        status = re2.main(list(argv) + ['-j', '1'], out)
+        return status, out.getvalue()
+
+    def setUp(self):
+        fd, self.path = tempfile.mkstemp()
+        with os.fdopen(fd, 'wb') as f:
+            f.write(b'abc\nxabc\nab\n\nabcabc\n')
+
+    def tearDown(self):
+        os.remove(self.path)
+
+    def test_lines(self):
+        self.assertEqual(self.grep('b+c', self.path), (0, b'abc\nxabc\nabcabc\n'))
+        self.assertEqual(self.grep('^ab$', self.path, '-n'), (0, b'3:ab\n'))
+        self.assertEqual(self.grep('z', self.path), (1, b''))
+
+    def test_segments(self):
+        # the segments break the lines, each line is still printed once
+        status, out = self.grep('a', self.path, '-n', '--segment-size', '3')
+        self.assertEqual(out, b'1:abc\n2:xabc\n3:ab\n5:abcabc\n')
+        status, out = self.grep('bc', self.path, '-c', '--segment-size', '2')
+        self.assertEqual(out, b'3\n')
+
+    def test_only_matching(self):
+        status, out = self.grep('ab*c', self.path, '-o', '-n')
+        self.assertEqual(out, b'1:abc\n2:abc\n5:abc\n5:abc\n')
+        status, out = self.grep('c.?a', self.path, '-w')
+        self.assertEqual(out, b'7:c\na\n15:ca\n')
+
+
+class TestSearchMany(unittest.TestCase):
+    def test_pickle(self):
+        re = pickle.loads(pickle.dumps(RegExp('(a+)b')))
+        self.assertIsNone(re.tokenizer) # not parsed again
+        self.assertEqual(re.exec('xaab').group(1), 'aa')
+
+    def test_order(self):
+        records = ['ab', 'b', 'xaab', b'aab'] * 50
+        expected = [RegExp('(a+)b').exec(r) for r in records]
+        expected = [m and (m.span(), m.groups()) for m in expected]
+        for workers in (1, 2):
+            result = re2.searchMany('(a+)b', iter(records), workers, 7)
+            result = [m and (m.span(), m.groups()) for m in result]
+            self.assertEqual(result, expected)
+
+    def test_default_workers(self):
+        class Pool(Exception):
+            def __init__(self, *args, **kwargs):
+                raise self
+        re = RegExp('(a+)b')
+        re.PARALLEL_CHUNKS = 2
+        with mock.patch('re2.ProcessPoolExecutor', Pool):
+            # a few records are searched in process
+            result = list(re.searchMany(['ab', 'b'] * 3, chunksize=2))
+            self.assertEqual([m and m.group() for m in result],
+                             ['ab', None] * 3)
+            with mock.patch('os.cpu_count', lambda: 2):
+                with self.assertRaises(Pool):
+                    list(re.searchMany(['ab', 'b'] * 4, chunksize=2))
+
+class TestBench(unittest.TestCase):
+    def test_corpus(self):
+        import bench
+        self.assertEqual(bench.corpus('log', 1000), bench.corpus('log', 1000))
+        self.assertNotEqual(bench.corpus('log', 1000, 1), bench.corpus('log', 1000))
+        self.assertGreaterEqual(len('\n'.join(bench.corpus('csv', 1000))), 999)
+
+    def test_run(self):
+        import bench
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.json')
+            out = io.StringIO()
+            bench.main(['--quick', '--family', 'literal', '-o', path], out)
+            with open(path) as f:
+                result = json.load(f)
+            self.assertEqual(len(result['cases']), 2)
+            case = result['cases'][0]
+            self.assertEqual(case['re2']['matches'], case['re']['matches'])
+            self.assertIn('p99', case['re2']['latency'])
+            out = io.StringIO()
+            bench.main(['--compare', path, path], out)
+            self.assertIn('scan 1.00x', out.getvalue())
+
 
 if __name__ == '__main__':
     cov = coverage.coverage(branch=True, include='re2.py')